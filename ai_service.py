@@ -4,223 +4,567 @@ import json
 import logging
 import asyncio
 import time
-import io
-from PIL import Image
-from config import GEMINI_API_KEY, GEMINI_IMAGE_MODEL, GEMINI_IMAGE_MODEL_FALLBACK
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from config import (
+    GEMINI_API_KEY, GEMINI_API_BASE, GEMINI_IMAGE_MODEL, GEMINI_IMAGE_MODEL_FALLBACK,
+    GEMINI_FILE_UPLOAD, GEMINI_FILE_URI_TTL,
+    IMAGE_WORKERS, IMAGE_MAX_PENDING, IMAGE_MAX_DIMENSION, IMAGE_JPEG_QUALITY, IMAGE_PASSTHROUGH_MAX_BYTES,
+    STICKER_CACHE_ENABLED, STICKER_CACHE_DIR, STICKER_CACHE_MEMORY_BYTES, STICKER_CACHE_DISK_BYTES,
+    HEDGE_ENABLED, HEDGE_DELAY_SECONDS, HEDGE_MIN_DELAY_SECONDS, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES, HEDGE_MAX_RATIO,
+    MODEL_TIMEOUT_PERCENTILE, MODEL_TIMEOUT_MULTIPLIER, MODEL_TIMEOUT_MIN_SECONDS, MODEL_TIMEOUT_MAX_SECONDS,
+    CIRCUIT_FAILURE_RATE, CIRCUIT_CONSECUTIVE_FAILURES, CIRCUIT_COOLDOWN_SECONDS,
+    GEMINI_MODEL_QUOTAS, RATE_LIMIT_MAX_WAIT_SECONDS, DOWNLOAD_MAX_BYTES, DOWNLOAD_RESIZED,
+    GEMINI_POOL_LIMIT, GEMINI_POOL_LIMIT_PER_HOST, DOWNLOAD_POOL_LIMIT, DOWNLOAD_POOL_LIMIT_PER_HOST,
+    HTTP_KEEPALIVE_SECONDS, HTTP_DNS_CACHE_SECONDS, HTTP_WARM_CONNECTIONS, HTTP_WARM_INTERVAL_SECONDS,
+)
+from file_upload import FileUploader
+from gemini_stream import GenerateContentParser, truncate
+from http_pools import HttpPool, KeepWarm
+from image_pipeline import ImagePipeline, OptimizedImage
+from metrics import ATTEMPTS, BYTES, CACHE_LOOKUPS, FALLBACKS, IMAGE_CPU_SECONDS, IN_FLIGHT, STAGE_SECONDS
+from model_health import HealthTracker, HedgeBudget
+from presets import PRESET_CACHE_TTL
+from rate_limit import RateLimiter, RateLimitError, estimate_tokens, parse_retry_after
+from singleflight import SingleFlight
+from sticker_cache import StickerCache, make_cache_key
 
 logger = logging.getLogger(__name__)
 
+# Read size for streaming generateContent responses
+RESPONSE_CHUNK_SIZE = 64 * 1024
+JSON_HEADERS = {"Content-Type": "application/json"}
+
 class NonRetryableError(Exception):
     """Exception raised for errors that should not trigger a retry."""
     pass
 
+class StaleFileError(NonRetryableError):
+    """Exception raised when an uploaded reference file URI is rejected."""
+    pass
+
+class ImageTooLargeError(NonRetryableError):
+    """Exception raised when an image to download exceeds DOWNLOAD_MAX_BYTES."""
+    pass
+
+class GenerationTimeoutError(Exception):
+    """Exception raised when a Gemini call exceeds its timeout."""
+    pass
+
+class _Attempt:
+    """One generateContent call in _generate_with_fallback; timed from when it is sent, not queued."""
+
+    def __init__(self, model: str, label: str):
+        self.model = model
+        self.label = label
+        self.started = None
+        self.sent = asyncio.Event()
+
+    def mark_sent(self):
+        self.started = time.time()
+        self.sent.set()
+
+    def elapsed(self):
+        return None if self.started is None else time.time() - self.started
+
+# Content types accepted for downloads besides image/*
+GENERIC_CONTENT_TYPES = ("application/octet-stream", "binary/octet-stream")
+
+def downscaled_proxy_url(proxy_url: str, width: int, height: int, max_dimension: int):
+    """
+    Returns a Discord media proxy URL that serves the attachment scaled to fit
+    max_dimension, or None if the image is already small enough or its size is unknown.
+    """
+    if not proxy_url or not width or not height or max(width, height) <= max_dimension:
+        return None
+    scale = max_dimension / max(width, height)
+    parts = urlsplit(proxy_url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in ("width", "height")]
+    query += [("width", str(max(1, round(width * scale)))), ("height", str(max(1, round(height * scale))))]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
 class AIService:
     def __init__(self):
         self.api_key = GEMINI_API_KEY
-        self.base_url = "https://generativelanguage.googleapis.com/v1beta/models"
-        self._session = None
+        self.base_url = f"{GEMINI_API_BASE}/v1beta/models"
+        self.gemini_pool = HttpPool(
+            "gemini", GEMINI_POOL_LIMIT, GEMINI_POOL_LIMIT_PER_HOST, HTTP_KEEPALIVE_SECONDS, HTTP_DNS_CACHE_SECONDS,
+            # Listing one model is the cheapest authenticated call on the Gemini host
+            probe_urls=[f"{self.base_url}?pageSize=1&key={self.api_key}"],
+        )
+        self.download_pool = HttpPool(
+            "download", DOWNLOAD_POOL_LIMIT, DOWNLOAD_POOL_LIMIT_PER_HOST, HTTP_KEEPALIVE_SECONDS,
+            HTTP_DNS_CACHE_SECONDS, probe_urls=["https://cdn.discordapp.com/", "https://media.discordapp.net/"],
+            probe_method="HEAD",
+        )
+        self.keep_warm = KeepWarm([self.gemini_pool, self.download_pool], HTTP_WARM_INTERVAL_SECONDS)
+        self.uploader = FileUploader(self.get_session, self.api_key, f"{GEMINI_API_BASE}/upload/v1beta/files",
+                                     ttl=GEMINI_FILE_URI_TTL)
+        self.image_pipeline = ImagePipeline(
+            workers=IMAGE_WORKERS,
+            max_pending=IMAGE_MAX_PENDING,
+            max_size=(IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION),
+            quality=IMAGE_JPEG_QUALITY,
+            passthrough_max_bytes=IMAGE_PASSTHROUGH_MAX_BYTES,
+        )
+        self._inflight = SingleFlight()
+        self.health = HealthTracker(
+            timeout_percentile=MODEL_TIMEOUT_PERCENTILE,
+            timeout_multiplier=MODEL_TIMEOUT_MULTIPLIER,
+            timeout_min=MODEL_TIMEOUT_MIN_SECONDS,
+            timeout_max=MODEL_TIMEOUT_MAX_SECONDS,
+            failure_rate=CIRCUIT_FAILURE_RATE,
+            consecutive_failures=CIRCUIT_CONSECUTIVE_FAILURES,
+            cooldown=CIRCUIT_COOLDOWN_SECONDS,
+        )
+        self.hedge_budget = HedgeBudget(HEDGE_MAX_RATIO)
+        self.rate_limiter = RateLimiter(GEMINI_MODEL_QUOTAS, RATE_LIMIT_MAX_WAIT_SECONDS)
+        self.cache = None
+        if STICKER_CACHE_ENABLED:
+            self.cache = StickerCache(STICKER_CACHE_DIR, STICKER_CACHE_MEMORY_BYTES, STICKER_CACHE_DISK_BYTES)
 
     async def get_session(self):
-        if self._session is None or self._session.closed:
-            self._session = aiohttp.ClientSession()
-        return self._session
+        """Session for Gemini API calls and uploads."""
+        return await self.gemini_pool.session()
+
+    async def get_download_session(self):
+        """Session for attachment and CDN downloads."""
+        return await self.download_pool.session()
+
+    async def warm_up(self, gemini: bool = True):
+        """Opens connections to Gemini and the Discord CDN ahead of the first request, then keeps them warm."""
+        pools = [self.gemini_pool, self.download_pool] if gemini else [self.download_pool]
+        start_time = time.time()
+        await asyncio.gather(*(pool.warm(HTTP_WARM_CONNECTIONS) for pool in pools))
+        logger.info(f"Warmed HTTP connection pools in {time.time() - start_time:.2f}s: {self.pool_stats()}")
+        self.keep_warm.pools = pools
+        self.keep_warm.start()
+
+    def pool_stats(self) -> dict:
+        return {"gemini": self.gemini_pool.stats(), "download": self.download_pool.stats()}
+
+    def inflight_stats(self) -> dict:
+        """Distinct generations in flight, and requests that joined one instead of calling Gemini."""
+        return {"generations": len(self._inflight), "coalesced": self._inflight.coalesced}
 
     async def close(self):
-        if self._session and not self._session.closed:
-            await self._session.close()
+        self.keep_warm.stop()
+        await self.gemini_pool.close()
+        await self.download_pool.close()
+        self.image_pipeline.close()
 
-    async def download_image(self, url: str) -> bytes:
-        """Downloads image from a URL."""
-        session = await self.get_session()
+    async def download_attachment(self, url: str, size: int = None, proxy_url: str = None,
+                                  width: int = None, height: int = None) -> bytes:
+        """
+        Downloads a Discord attachment, preferring a proxy variant already scaled
+        down to IMAGE_MAX_DIMENSION so fewer bytes are moved and decoded.
+        """
+        resized_url = downscaled_proxy_url(proxy_url, width, height, IMAGE_MAX_DIMENSION) if DOWNLOAD_RESIZED else None
+        if resized_url:
+            try:
+                data = await self.download_image(resized_url)
+                logger.info(f"Downloaded resized attachment ({width}x{height} -> {len(data)/1024:.1f}KB)")
+                return data
+            except Exception as e:
+                logger.warning(f"Resized download failed, fetching original attachment: {e}")
+        return await self.download_image(url, expected_size=size)
+
+    async def download_image(self, url: str, max_bytes: int = DOWNLOAD_MAX_BYTES, expected_size: int = None) -> bytes:
+        """Streams an image from a URL into a bounded buffer, rejecting oversized or non-image bodies early."""
+        if expected_size is not None and expected_size > max_bytes:
+            raise ImageTooLargeError(f"Image is {expected_size/1024/1024:.1f}MB, the limit is {max_bytes/1024/1024:.0f}MB")
+        session = await self.get_download_session()
         try:
-            async with session.get(url, timeout=30) as response:
-                if response.status == 200:
-                    return await response.read()
-                else:
-                    raise Exception(f"Failed to download image. Status: {response.status}")
+            with STAGE_SECONDS.time(stage="download"):
+                async with session.get(url, timeout=30) as response:
+                    if response.status != 200:
+                        raise Exception(f"Failed to download image. Status: {response.status}")
+
+                    content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+                    if content_type and not content_type.startswith("image/") and content_type not in GENERIC_CONTENT_TYPES:
+                        raise NonRetryableError(f"Downloaded file is not an image ({content_type})")
+                    length = response.content_length
+                    if length is not None and length > max_bytes:
+                        raise ImageTooLargeError(f"Image is {length/1024/1024:.1f}MB, "
+                                                 f"the limit is {max_bytes/1024/1024:.0f}MB")
+
+                    buffer = bytearray()
+                    async for chunk in response.content.iter_chunked(RESPONSE_CHUNK_SIZE):
+                        if len(buffer) + len(chunk) > max_bytes:
+                            raise ImageTooLargeError(f"Image exceeds the {max_bytes/1024/1024:.0f}MB limit")
+                        buffer += chunk
+                    BYTES.inc(len(buffer), direction="in", kind="download")
+                    return bytes(buffer)
         except Exception as e:
             logger.error(f"Error downloading image: {e}")
             raise e
 
-    def optimize_image(self, image_bytes: bytes, max_size=(1024, 1024), quality=85) -> bytes:
-        """Resizes and compresses image to reduce payload size."""
-        try:
-            img = Image.open(io.BytesIO(image_bytes))
-            # Convert to RGB if necessary for JPEG
-            if img.mode in ("RGBA", "P"):
-                # Use white background for transparent images when converting to JPEG
-                background = Image.new("RGB", img.size, (255, 255, 255))
-                if img.mode == "RGBA":
-                    background.paste(img, mask=img.split()[3])
-                else:
-                    background.paste(img)
-                img = background
-            elif img.mode != "RGB":
-                img = img.convert("RGB")
-            
-            # Thumbnail keeps aspect ratio
-            img.thumbnail(max_size, Image.Resampling.LANCZOS)
-            
-            output = io.BytesIO()
-            img.save(output, format="JPEG", quality=quality, optimize=True)
-            optimized_bytes = output.getvalue()
-            
-            logger.info(f"Image optimized: {len(image_bytes)/1024:.1f}KB -> {len(optimized_bytes)/1024:.1f}KB")
-            return optimized_bytes
-        except Exception as e:
-            logger.warning(f"Failed to optimize image: {e}. Using original.")
-            return image_bytes
+    async def optimize_image(self, image_bytes: bytes, mime_type: str = "image/jpeg") -> OptimizedImage:
+        """Resizes and compresses image in the worker pool to reduce payload size."""
+        optimized = await self.image_pipeline.optimize(image_bytes, mime_type)
+        STAGE_SECONDS.observe(optimized.wall_time, stage="optimize")
+        IMAGE_CPU_SECONDS.observe(optimized.cpu_time, reencoded=str(optimized.reencoded).lower())
+        return optimized
 
-    async def _call_generate_api(self, model: str, payload: dict, timeout: int = 60) -> bytes:
+    async def _call_generate_api(self, model: str, body: bytes, timeout: int = 60, tokens: int = 0,
+                                 on_send=None) -> bytes:
+        """
+        Posts a pre-serialized generateContent request body and returns the image bytes.
+        on_send() is called once the rate limiter lets the request go, i.e. when the call really starts.
+        """
         url = f"{self.base_url}/{model}:generateContent?key={self.api_key}"
         
+        # Wait briefly for client-side quota (or a server Retry-After) instead of burning a call
+        with STAGE_SECONDS.time(stage="rate_limit_wait", model=model):
+            await self.rate_limiter.acquire(model, tokens)
+        if on_send is not None:
+            on_send()
         session = await self.get_session()
         client_timeout = aiohttp.ClientTimeout(total=timeout)
         
         try:
-            async with session.post(url, json=payload, timeout=client_timeout) as response:
-                if response.status != 200:
-                    text = await response.text()
-                    logger.error(f"Generate sticker failed ({model}): {text}")
-                    # 4xx errors are usually client errors (bad request, permission, etc) and often not retryable
-                    # but 429 is retryable.
-                    if response.status == 400:
-                         raise NonRetryableError(f"Gemini API Error (Bad Request): {text}")
-                    raise Exception(f"Gemini API Error (Generate {model}): {response.status}")
-                
-                data = await response.json()
-                
-                try:
-                    candidates = data.get("candidates", [])
-                    if not candidates:
-                        prompt_feedback = data.get("promptFeedback", {})
-                        block_reason = prompt_feedback.get("blockReason")
-                        if block_reason:
-                            raise NonRetryableError(f"Generation blocked by safety filters: {block_reason}")
-                        logger.error(f"No candidates returned. Full response: {json.dumps(data)}")
-                        raise Exception("No candidates returned from Gemini API")
-
-                    parts = candidates[0].get("content", {}).get("parts", [])
-                    text_responses = []
-                    
-                    for part in parts:
-                        # Check for both snake_case (Python SDK style) and camelCase (JSON API style)
-                        if "inline_data" in part:
-                            b64_data = part["inline_data"]["data"]
-                            return base64.b64decode(b64_data)
-                        
-                        if "inlineData" in part:
-                            data_obj = part["inlineData"]
-                            b64_data = data_obj.get("data")
-                            if b64_data:
-                                return base64.b64decode(b64_data)
-
-                        if "text" in part:
-                            text_content = part["text"]
-                            if text_content.startswith("http"):
-                                return await self.download_image(text_content)
-                            else:
-                                logger.info(f"Received text instead of image: {text_content}")
-                                text_responses.append(text_content)
-                    
-                    # If we got here, we didn't find an image
-                    if text_responses:
-                         # The model refused or just chatted instead of generating an image
-                         combined_text = " ".join(text_responses)
-                         raise NonRetryableError(f"Model refused to generate image. Response: {combined_text}")
-
-                    keys_found = [list(p.keys()) for p in parts]
-                    logger.error(f"No image data found. Parts keys: {keys_found}. Full response: {json.dumps(data)}")
-                    raise Exception("No image data found in response")
-                    
-                except NonRetryableError:
-                    raise
-                except Exception as e:
-                    logger.error(f"Failed to parse image response: {e}")
-                    if "Full response" not in str(e):
-                        logger.debug(f"Response data: {data}")
-                    raise e
+            with IN_FLIGHT.track(stage="gemini_call"):
+                return await self._post_generate(session, url, model, body, client_timeout)
         except asyncio.TimeoutError:
             logger.error(f"Timeout calling Gemini API ({model}) after {timeout}s")
-            raise Exception(f"Timeout calling Gemini API ({model})")
-        except NonRetryableError:
+            raise GenerationTimeoutError(f"Timeout calling Gemini API ({model})")
+        except (NonRetryableError, RateLimitError):
             raise
         except Exception as e:
             logger.error(f"Error calling Gemini API ({model}): {e}")
             raise e
 
-    async def generate_sticker(self, sticker_prompt: str, reference_image_bytes: bytes, mime_type: str = "image/png") -> bytes:
+    async def _post_generate(self, session, url: str, model: str, body: bytes, client_timeout) -> bytes:
+        BYTES.inc(len(body), direction="out", kind="gemini_request")
+        sent_at = time.perf_counter()
+        async with session.post(url, data=body, headers=JSON_HEADERS, timeout=client_timeout) as response:
+            # Time to response headers ~ Gemini server time plus upload
+            STAGE_SECONDS.observe(time.perf_counter() - sent_at, stage="gemini_response", model=model)
+            if response.status != 200:
+                text = truncate(await response.text(), 2000)
+                logger.error(f"Generate sticker failed ({model}): {text}")
+                if response.status == 429:
+                    retry_after, quota_id = parse_retry_after(response.headers, text)
+                    self.rate_limiter.penalize(model, retry_after)
+                    raise RateLimitError(f"Gemini API Error (Rate limited {model}, quota: {quota_id})",
+                                         model=model, retry_after=retry_after)
+                if response.status in (400, 403, 404) and "file" in text.lower() and b'"fileUri"' in body:
+                    raise StaleFileError(f"Gemini API Error (Reference file rejected): {text}")
+                # 4xx errors are usually client errors (bad request, permission, etc) and often not retryable
+                if response.status == 400:
+                     raise NonRetryableError(f"Gemini API Error (Bad Request): {text}")
+                raise Exception(f"Gemini API Error (Generate {model}): {response.status}")
+            
+            # Decode the (multi-MB, mostly base64) body as it streams in
+            parser = GenerateContentParser()
+            with STAGE_SECONDS.time(stage="gemini_decode", model=model):
+                async for chunk in response.content.iter_chunked(RESPONSE_CHUNK_SIZE):
+                    parser.feed(chunk)
+            BYTES.inc(parser.summary()["bytes"], direction="in", kind="gemini_response")
+            
+            try:
+                image_bytes = parser.image()
+                if image_bytes:
+                    return image_bytes
+
+                if not parser.has_candidates:
+                    if parser.block_reason:
+                        raise NonRetryableError(f"Generation blocked by safety filters: {parser.block_reason}")
+                    logger.error(f"No candidates returned. Response summary: {parser.summary()}")
+                    raise Exception("No candidates returned from Gemini API")
+
+                text_responses = []
+                for text_content in parser.texts:
+                    if text_content.startswith("http"):
+                        return await self.download_image(text_content)
+                    else:
+                        logger.info(f"Received text instead of image: {truncate(text_content)}")
+                        text_responses.append(text_content)
+                
+                # If we got here, we didn't find an image
+                if text_responses:
+                     # The model refused or just chatted instead of generating an image
+                     combined_text = truncate(" ".join(text_responses), 1000)
+                     raise NonRetryableError(f"Model refused to generate image. Response: {combined_text}")
+
+                logger.error(f"No image data found. Parts keys: {parser.part_keys}. Response summary: {parser.summary()}")
+                raise Exception("No image data found in response")
+                
+            except NonRetryableError:
+                raise
+            except Exception as e:
+                logger.error(f"Failed to parse image response: {e}")
+                raise e
+
+    async def generate_sticker(self, sticker_prompt: str, reference_image_bytes: bytes, mime_type: str = "image/png",
+                               style_name: str = None, reuse_reference: bool = False, gate=None) -> bytes:
         """
         Calls Gemini to generate the sticker with optimized timeout and fallback.
+        Results for presets listed in PRESET_CACHE_TTL are served from the sticker cache.
+        Pass reuse_reference=True when the same photo is about to be used for several
+        generations, so it is uploaded once (GEMINI_FILE_UPLOAD=auto) and referenced by URI.
+        If given, gate(factory) wraps only the upstream generation (e.g. the job scheduler),
+        so cache hits and requests joining an identical in-flight generation skip it.
         """
         if not self.api_key:
             raise ValueError("GEMINI_API_KEY is not set")
         
-        # Optimize image before sending to API
-        optimized_image_bytes = self.optimize_image(reference_image_bytes)
-        image_b64 = base64.b64encode(optimized_image_bytes).decode('utf-8')
-        
+        # Optimize image before sending to API (runs in the image worker pool)
+        optimized = await self.optimize_image(reference_image_bytes, mime_type)
+        return await self.generate_from_reference(sticker_prompt, optimized, style_name, reuse_reference, gate)
+
+    async def generate_from_reference(self, sticker_prompt: str, optimized: OptimizedImage, style_name: str = None,
+                                      reuse_reference: bool = False, gate=None) -> bytes:
+        """Same as generate_sticker, for a reference already run through optimize_image."""
+        if not self.api_key:
+            raise ValueError("GEMINI_API_KEY is not set")
+
+        request_key = make_cache_key(optimized.data, style_name, sticker_prompt,
+                                     f"{GEMINI_IMAGE_MODEL}|{GEMINI_IMAGE_MODEL_FALLBACK}")
+        cache_ttl = PRESET_CACHE_TTL.get(style_name) if self.cache and style_name else None
+        if cache_ttl:
+            cached = await self.cache.get(request_key, cache_ttl)
+            if cached is not None:
+                CACHE_LOOKUPS.inc(result="hit")
+                logger.info(f"Sticker cache hit for style {style_name} ({request_key[:12]})")
+                return cached
+            CACHE_LOOKUPS.inc(result="miss")
+
+        def generate():
+            return self._generate_and_store(sticker_prompt, optimized, request_key if cache_ttl else None,
+                                            reuse_reference)
+
+        # Identical concurrent requests share one upstream generation, and only its leader passes the gate
+        return await self._inflight.do(request_key, generate if gate is None else lambda: gate(generate))
+
+    async def _reference_part(self, optimized: OptimizedImage, reuse_reference: bool):
+        """Returns the request part for the reference image and the file URI it points at, if any."""
+        if GEMINI_FILE_UPLOAD != "off":
+            uri = self.uploader.cached_uri(optimized.data)
+            if uri is None and (GEMINI_FILE_UPLOAD == "always" or reuse_reference):
+                try:
+                    with STAGE_SECONDS.time(stage="file_upload"):
+                        uri = await self.uploader.get_uri(optimized.data, optimized.mime_type)
+                except Exception as e:
+                    logger.warning(f"Reference upload failed, sending image inline: {e}")
+            if uri:
+                return {"fileData": {"mimeType": optimized.mime_type, "fileUri": uri}}, uri
+
+        return self._inline_part(optimized), None
+
+    @staticmethod
+    def _inline_part(optimized: OptimizedImage) -> dict:
+        image_b64 = base64.b64encode(optimized.data).decode('utf-8')
+        return {"inlineData": {"mimeType": optimized.mime_type, "data": image_b64}}
+
+    @staticmethod
+    def _build_request_body(sticker_prompt: str, reference_part: dict) -> bytes:
+        """Serializes the generateContent request once so every attempt reuses the same bytes."""
         payload = {
             "contents": [{
                 "parts": [
                     {"text": f"Generate a sticker based on this prompt: {sticker_prompt}"},
-                    {
-                        "inlineData": {
-                            "mimeType": "image/jpeg", # Since we optimized to JPEG
-                            "data": image_b64
-                        }
-                    }
+                    reference_part
                 ]
             }],
             "generationConfig": {
                 "responseModalities": ["TEXT", "IMAGE"]
             }
         }
+        return json.dumps(payload, separators=(",", ":")).encode("utf-8")
 
-        # Attempt 1: Primary Model
-        primary_timeout = 20
-        start_time = time.time()
-        try:
-            logger.info(f"Attempt 1: Generating with {GEMINI_IMAGE_MODEL} (timeout={primary_timeout}s)...")
-            return await self._call_generate_api(GEMINI_IMAGE_MODEL, payload, timeout=primary_timeout)
-        except NonRetryableError as e:
-            logger.error(f"Attempt 1 failed with non-retryable error: {e}")
-            raise e
-        except Exception as e:
-            elapsed = time.time() - start_time
-            logger.warning(f"Attempt 1 failed ({GEMINI_IMAGE_MODEL}): {e}. Elapsed: {elapsed:.2f}s")
-            
-            # Quick Retry (Attempt 2): If failure happened within 5 seconds
-            if elapsed < 5:
-                try:
-                    retry_timeout = 15
-                    logger.info(f"Attempt 2: Quick retry with {GEMINI_IMAGE_MODEL} (timeout={retry_timeout}s)...")
-                    return await self._call_generate_api(GEMINI_IMAGE_MODEL, payload, timeout=retry_timeout)
-                except NonRetryableError as e2:
-                     logger.error(f"Attempt 2 failed with non-retryable error: {e2}")
-                     raise e2
-                except Exception as e2:
-                    logger.warning(f"Attempt 2 failed: {e2}.")
-            else:
-                logger.warning(f"Attempt 1 took > 5s or timed out, skipping quick retry...")
-
-        # Fallback Model with Retries
-        fallback_timeout = 15
+    async def _generate_and_store(self, sticker_prompt: str, optimized: OptimizedImage, cache_key: str = None,
+                                  reuse_reference: bool = False) -> bytes:
+        """Builds the request body, generates the sticker and stores it in the cache if keyed."""
+        reference_part, file_uri = await self._reference_part(optimized, reuse_reference)
+        with STAGE_SECONDS.time(stage="encode"):
+            body = self._build_request_body(sticker_prompt, reference_part)
+        tokens = estimate_tokens(sticker_prompt)
+
+        with STAGE_SECONDS.time(stage="generate"):
+            try:
+                result = await self._generate_with_fallback(body, tokens)
+            except StaleFileError as e:
+                logger.warning(f"Uploaded reference {file_uri} was rejected ({e}), retrying with inline image.")
+                FALLBACKS.inc(kind="inline_reference")
+                self.uploader.invalidate(file_uri)
+                body = self._build_request_body(sticker_prompt, self._inline_part(optimized))
+                result = await self._generate_with_fallback(body, tokens)
+
+        if cache_key:
+            await self.cache.set(cache_key, result)
+        return result
+
+    def _hedge_delay(self, primary_timeout: float) -> float:
+        """Seconds to wait on the primary model before hedging, from its observed latency percentile."""
+        primary = self.health.get(GEMINI_IMAGE_MODEL)
+        delay = HEDGE_DELAY_SECONDS
+        if primary.sample_count() >= HEDGE_MIN_SAMPLES:
+            delay = primary.percentile(HEDGE_PERCENTILE)
+        return min(max(delay, HEDGE_MIN_DELAY_SECONDS), primary_timeout)
+
+    def health_snapshot(self) -> dict:
+        """Circuit state, error rate and latency percentiles per model."""
+        return self.health.snapshot()
+
+    async def _generate_with_fallback(self, body: bytes, tokens: int = 0) -> bytes:
+        """
+        Runs the primary model, quick retry and fallback attempts for one request body.
+
+        Timeouts follow each model's recent latency, and models whose circuit
+        breaker is open are skipped. Rate-limited models are not retried; the
+        fallback (which has its own quota) is tried instead. If the primary model is still running
+        after the hedge delay, the first fallback attempt is started alongside
+        it (subject to the hedge budget); whichever returns an image first wins
+        and the other is cancelled.
+        """
+        primary_timeout = self.health.timeout_for(GEMINI_IMAGE_MODEL, 20)
+        retry_timeout = self.health.timeout_for(GEMINI_IMAGE_MODEL, 15)
+        fallback_timeout = self.health.timeout_for(GEMINI_IMAGE_MODEL_FALLBACK, 15)
         fallback_retries = 2
-        
+
+        running = {}  # task -> _Attempt
+        fallbacks_started = 0
+        quick_retry_used = False
         last_error = None
-        for i in range(fallback_retries):
-            try:
-                attempt_num = i + 1
-                logger.info(f"Fallback Attempt {attempt_num}/{fallback_retries}: Generating with {GEMINI_IMAGE_MODEL_FALLBACK} (timeout={fallback_timeout}s)...")
-                return await self._call_generate_api(GEMINI_IMAGE_MODEL_FALLBACK, payload, timeout=fallback_timeout)
-            except NonRetryableError as e:
-                logger.error(f"Fallback Attempt {attempt_num} failed with non-retryable error: {e}")
-                raise e
-            except Exception as e:
-                last_error = e
-                logger.warning(f"Fallback Attempt {attempt_num} failed: {e}")
-        
+
+        def launch(model: str, label: str, timeout: float):
+            if not self.health.get(model).allow_request():
+                logger.warning(f"{label}: Skipping {model}, circuit breaker is open.")
+                ATTEMPTS.inc(model=model, outcome="skipped")
+                return None
+            logger.info(f"{label}: Generating with {model} (timeout={timeout:.1f}s)...")
+            attempt = _Attempt(model, label)
+            task = asyncio.create_task(self._call_generate_api(model, body, timeout=timeout, tokens=tokens,
+                                                               on_send=attempt.mark_sent))
+            running[task] = attempt
+            return attempt
+
+        def launch_fallback(label: str) -> bool:
+            nonlocal fallbacks_started
+            if fallbacks_started >= fallback_retries:
+                return False
+            fallbacks_started += 1
+            FALLBACKS.inc(kind="hedge" if running else "sequential")
+            if launch(GEMINI_IMAGE_MODEL_FALLBACK, f"{label} {fallbacks_started}/{fallback_retries}", fallback_timeout):
+                return True
+            fallbacks_started = fallback_retries
+            return False
+
+        self.hedge_budget.on_request()
+        hedge_delay = self._hedge_delay(primary_timeout)
+
+        # Attempt 1: Primary Model; the hedge delay counts from when it is actually sent
+        primary = launch(GEMINI_IMAGE_MODEL, "Attempt 1", primary_timeout)
+        hedged = primary if HEDGE_ENABLED else None  # attempt the hedge timer runs for
+        try:
+            while True:
+                # Fallback Model with Retries, once nothing else is in flight
+                if not running:
+                    hedged = None
+                    if not launch_fallback("Fallback Attempt"):
+                        break
+
+                waiting = set(running)
+                wait_timeout = None
+                sent_waiter = None
+                if hedged is not None and hedged.started is None:
+                    # Still held by the rate limiter: wake up when it is sent, then start the hedge timer
+                    sent_waiter = asyncio.create_task(hedged.sent.wait())
+                    waiting.add(sent_waiter)
+                elif hedged is not None:
+                    wait_timeout = max(0.0, hedged.started + hedge_delay - time.time())
+                try:
+                    done, _ = await asyncio.wait(waiting, timeout=wait_timeout, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    if sent_waiter is not None:
+                        sent_waiter.cancel()
+                done.discard(sent_waiter)
+
+                if not done:
+                    if sent_waiter is not None:
+                        continue
+                    hedged = None
+                    if fallbacks_started >= fallback_retries:
+                        continue
+                    if self.hedge_budget.try_acquire():
+                        launch_fallback("Hedge Fallback Attempt")
+                    else:
+                        logger.info("Primary model is slow but hedge budget is exhausted, not hedging.")
+                    continue
+
+                # Prefer a success if several attempts finished together, but record every finished attempt
+                winner = None
+                non_retryable = None
+                for task in sorted(done, key=lambda t: t.exception() is not None):
+                    attempt = running.pop(task)
+                    model, label = attempt.model, attempt.label
+                    health = self.health.get(model)
+                    # None if it never got past the rate limiter
+                    elapsed = attempt.elapsed()
+                    if attempt is hedged and elapsed is None:
+                        hedged = None
+                    try:
+                        result = task.result()
+                    except NonRetryableError as e:
+                        health.record_cancelled()
+                        ATTEMPTS.inc(model=model, outcome="non_retryable")
+                        logger.error(f"{label} failed with non-retryable error: {e}")
+                        non_retryable = e
+                        continue
+                    except RateLimitError as e:
+                        # Quota says nothing about model health, and retrying the same model would just 429 again
+                        health.record_cancelled()
+                        ATTEMPTS.inc(model=model, outcome="rate_limited")
+                        last_error = e
+                        if model == GEMINI_IMAGE_MODEL:
+                            quick_retry_used = True
+                        else:
+                            fallbacks_started = fallback_retries
+                        retry_after = "unknown" if e.retry_after is None else f"{e.retry_after:.1f}s"
+                        logger.warning(f"{label} rate limited ({model}): {e}. Retry after: {retry_after}")
+                        continue
+                    except Exception as e:
+                        # A timeout still tells us the call took at least `elapsed`
+                        health.record_failure(elapsed if isinstance(e, GenerationTimeoutError) else None)
+                        ATTEMPTS.inc(model=model, outcome="error")
+                        last_error = e
+                        logger.warning(f"{label} failed ({model}): {e}. Elapsed: {elapsed or 0:.2f}s")
+                        if model == GEMINI_IMAGE_MODEL and not quick_retry_used and winner is None:
+                            quick_retry_used = True
+                            # Quick Retry (Attempt 2): If failure happened fast enough to look transient
+                            cutoff = self.health.quick_retry_cutoff(GEMINI_IMAGE_MODEL)
+                            if (elapsed or 0) < cutoff:
+                                launch(GEMINI_IMAGE_MODEL, "Attempt 2: Quick retry", retry_timeout)
+                            else:
+                                logger.warning(f"Attempt 1 took > {cutoff:.1f}s or timed out, skipping quick retry...")
+                        continue
+
+                    health.record_success(elapsed)
+                    ATTEMPTS.inc(model=model, outcome="success")
+                    if winner is None:
+                        winner = (result, label, model, elapsed)
+
+                if winner is not None:
+                    result, label, model, elapsed = winner
+                    if running:
+                        logger.info(f"{label} won ({model}, {elapsed:.2f}s), cancelling {len(running)} other attempt(s).")
+                    return result
+                if non_retryable is not None:
+                    raise non_retryable
+        finally:
+            for task, attempt in running.items():
+                task.cancel()
+                # Attempts still waiting on the rate limiter never reached Gemini: no sample, no attempt
+                self.health.get(attempt.model).record_cancelled(attempt.elapsed())
+                if attempt.started is not None:
+                    ATTEMPTS.inc(model=attempt.model, outcome="cancelled")
+
+        if last_error is None:
+            last_error = Exception("All models are temporarily unavailable (circuit breaker open)")
+        if isinstance(last_error, RateLimitError):
+            logger.error(f"All attempts rate limited. Last error: {last_error}")
+            raise last_error
+
         # If all attempts failed
         error_msg = f"Failed to generate sticker. Code: 500, Reason: All attempts exhausted. Last error: {str(last_error)}"
         logger.error(error_msg)
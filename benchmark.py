@@ -0,0 +1,420 @@
+"""
+Offline load test for AIService and the /post handler, against mock_gemini.py.
+
+    python benchmark.py --mode service --requests 200 --concurrency 20 --latency 2 --latency-dist lognormal \\
+        --latency-jitter 0.4
+    python benchmark.py --mode post --requests 100 --concurrency 10 --rate-limit-rate 0.05 \\
+        --server-error-rate 0.05 --fault-models gemini-3.1-flash-image-preview --json
+
+The mock server runs in a subprocess so it shares neither our event loop nor
+our memory. The bot is pointed at it through environment variables, set
+before any bot module is imported. The report covers throughput,
+p50/p95/p99 latency, outcomes, Gemini attempts and fallbacks, peak RSS and
+event-loop lag. In post mode the real slash command callback runs against a
+stubbed discord.Interaction.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_gemini import FAULTS
+# presets.py has no imports, so it is safe to load before configure_env
+from presets import PRESET_CACHE_TTL, STICKER_PRESETS
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, q: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        return None
+
+
+def make_photo(path: str, width: int, height: int):
+    """Writes a noisy JPEG, which compresses about as badly as a real phone photo."""
+    from PIL import Image
+
+    Image.effect_noise((width, height), 48).convert("RGB").save(path, "JPEG", quality=92)
+
+
+def configure_env(args, base_url: str, workdir: str):
+    """Points config.py at the mock server; must run before bot modules are imported."""
+    os.environ.update({
+        "GEMINI_API_BASE": base_url,
+        "GEMINI_API_KEY": "benchmark",
+        "DISCORD_TOKEN": "benchmark",
+        "GENERATION_BACKEND": "local",
+        "METRICS_PORT": "0",
+        "COMMAND_SYNC": "off",
+        "HTTP_WARM_INTERVAL_SECONDS": "0",
+        "STICKER_CACHE_ENABLED": "true" if args.cache else "false",
+        "STICKER_CACHE_DIR": os.path.join(workdir, "stickers"),
+    })
+    # Every request comes from its own user, and nothing should bounce off the queue limits
+    os.environ.setdefault("QUEUE_MAX_DEPTH", str(max(50, args.requests)))
+    if args.gemini_concurrency:
+        os.environ["GEMINI_MAX_CONCURRENCY"] = str(args.gemini_concurrency)
+
+
+async def start_mock(args, port: int, attachment: str) -> subprocess.Popen:
+    command = [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_gemini.py"),
+        "--port", str(port),
+        "--latency", str(args.latency),
+        "--latency-dist", args.latency_dist,
+        "--latency-jitter", str(args.latency_jitter),
+        "--image-kb", str(args.image_kb),
+        "--hang-seconds", str(args.hang_seconds),
+        "--fault-models", args.fault_models,
+        "--attachment", attachment,
+    ]
+    for kind in FAULTS:
+        command += [f"--{kind.replace('_', '-')}-rate", str(getattr(args, f"{kind}_rate"))]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError("Mock Gemini server exited during startup")
+            await asyncio.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Mock Gemini server did not start")
+
+
+class StubUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.mention = f"<@{user_id}>"
+
+
+class StubResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def defer(self, thinking: bool = False, ephemeral: bool = False):
+        self.interaction.deferred = True
+
+    async def send_message(self, content=None, ephemeral: bool = False, **kwargs):
+        self.interaction.messages.append(content)
+
+
+class StubFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, file=None, ephemeral: bool = False, **kwargs):
+        self.interaction.record(content, [file] if file else [])
+
+
+class StubInteraction:
+    """The parts of discord.Interaction the slash command handlers use, recording what they send."""
+
+    def __init__(self, user_id: int, guild_id: int):
+        self.user = StubUser(user_id)
+        self.guild_id = guild_id
+        self.deferred = False
+        self.messages = []
+        self.delivered_bytes = 0
+        self.response = StubResponse(self)
+        self.followup = StubFollowup(self)
+
+    def record(self, content, files):
+        self.messages.append(content)
+        for file in files:
+            self.delivered_bytes += len(file.fp.read())
+            file.close()
+
+    async def edit_original_response(self, content=None, attachments=None, **kwargs):
+        self.record(content, attachments or [])
+
+
+class StubAttachment:
+    def __init__(self, url: str, size: int, width: int, height: int, content_type: str = "image/jpeg"):
+        self.url = url
+        self.proxy_url = None
+        self.size = size
+        self.width = width
+        self.height = height
+        self.content_type = content_type
+
+
+async def run_load(requests: int, concurrency: int, make_request):
+    """Runs make_request(i) for every request with at most `concurrency` in flight; returns (latency, outcome)."""
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def one(index: int):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                outcome = await make_request(index)
+            except Exception as e:
+                outcome = type(e).__name__
+            results.append((time.perf_counter() - start, outcome))
+
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return results
+
+
+def post_outcome(interaction: StubInteraction) -> str:
+    if interaction.delivered_bytes:
+        return "ok"
+    last = next((m for m in reversed(interaction.messages) if m), "no response")
+    return last.split(".")[0][:60]
+
+
+async def check_cache_hit(bot, post_request, style_name: str) -> dict:
+    """
+    Fills the job scheduler with stalled jobs, then posts a cached style: it
+    must be delivered from the cache without queueing behind them.
+    """
+    await post_request(-1, style_name)  # make sure the result is cached
+    scheduler = bot.client.scheduler
+    stall = asyncio.Event()
+    fillers = [
+        asyncio.create_task(scheduler.submit(-1000 - i, -1, stall.wait))
+        for i in range(scheduler.max_concurrency + scheduler.max_queue_depth)
+    ]
+    await asyncio.sleep(0)
+    queue_full = scheduler.queued >= scheduler.max_queue_depth
+    start = time.perf_counter()
+    try:
+        outcome = await asyncio.wait_for(post_request(-2, style_name), 10)
+    except asyncio.TimeoutError:
+        outcome = "timed out behind the queue"
+    elapsed = time.perf_counter() - start
+    stall.set()
+    await asyncio.gather(*fillers, return_exceptions=True)
+    return {"passed": queue_full and outcome == "ok", "queue_full": queue_full, "outcome": outcome,
+            "latency_ms": round(elapsed * 1000, 1)}
+
+
+async def benchmark(args):
+    workdir = tempfile.mkdtemp(prefix="viba-bench-")
+    photo_path = args.photo
+    if photo_path is None:
+        photo_path = os.path.join(workdir, "photo.jpg")
+        make_photo(photo_path, args.photo_width, args.photo_height)
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    configure_env(args, base_url, workdir)
+    mock = await start_mock(args, port, photo_path)
+
+    # Imported only now, so config.py sees the benchmark environment
+    from metrics import ATTEMPTS, FALLBACKS, LoopLagMonitor
+
+    lags = []
+    lag_monitor = LoopLagMonitor(interval=0.02, on_sample=lags.append)
+    photo_size = os.path.getsize(photo_path)
+    photo_url = f"{base_url}/attachments/0/photo.jpg"
+    base_prompt = STICKER_PRESETS[args.style]
+
+    def style_for(index: int) -> str:
+        """Unique prompts per request unless --duplicates, so request coalescing does not hide load."""
+        if args.duplicates:
+            return args.style
+        name = f"{args.style} (benchmark {index})"
+        STICKER_PRESETS[name] = f"{base_prompt} [benchmark request {index}]"
+        return name
+
+    if args.mode == "post":
+        import bot
+        from discord import app_commands
+
+        # bot.py configures INFO logging on import
+        logging.getLogger().setLevel(args.log_level)
+
+        service = bot.client.ai_service
+
+        async def post_request(index: int, style_name: str) -> str:
+            interaction = StubInteraction(user_id=10_000 + index, guild_id=index % args.guilds)
+            photo = StubAttachment(photo_url, photo_size, args.photo_width, args.photo_height)
+            await bot.post.callback(interaction, photo, app_commands.Choice(name=style_name, value=style_name))
+            return post_outcome(interaction)
+
+        async def make_request(index: int) -> str:
+            return await post_request(index, style_for(index))
+    else:
+        from ai_service import AIService
+
+        service = AIService()
+        reference = None
+
+        async def make_request(index: int) -> str:
+            style_name = style_for(index)
+            await service.generate_sticker(STICKER_PRESETS[style_name], reference, "image/jpeg",
+                                           style_name=style_name)
+            return "ok"
+
+    service.image_pipeline.start()
+    if args.mode == "service":
+        reference = await service.download_image(photo_url)
+    lag_monitor.start()
+
+    if args.warmup:
+        await run_load(args.warmup, args.concurrency, make_request)
+    rss_before = current_rss_mb()
+    attempts_before = ATTEMPTS.values()
+    started = time.perf_counter()
+    results = await run_load(args.requests, args.concurrency, make_request)
+    duration = time.perf_counter() - started
+    rss_after = current_rss_mb()
+    lag_monitor.stop()
+    cache_check = await check_cache_hit(bot, post_request, args.style) if args.check_cache_hit else None
+
+    session = await service.get_session()
+    async with session.get(f"{base_url}/stats") as response:
+        mock_stats = await response.json()
+    await service.close()
+    mock.terminate()
+    try:
+        mock.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        mock.kill()
+
+    latencies = [latency for latency, _ in results]
+    ok_latencies = [latency for latency, outcome in results if outcome == "ok"]
+    outcomes = {}
+    for _, outcome in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    attempts = {}
+    for (model, outcome), count in ATTEMPTS.values().items():
+        delta = count - attempts_before.get((model, outcome), 0)
+        if delta:
+            attempts[f"{model}/{outcome}"] = delta
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 1)
+
+    return {
+        "mode": args.mode,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "duration_s": round(duration, 2),
+        "throughput_rps": round(len(ok_latencies) / duration, 2) if duration else None,
+        "outcomes": outcomes,
+        "latency_ms": {
+            "p50": ms(percentile(latencies, 0.5)),
+            "p95": ms(percentile(latencies, 0.95)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "max": ms(max(latencies) if latencies else None),
+            "ok_p50": ms(percentile(ok_latencies, 0.5)),
+            "ok_p99": ms(percentile(ok_latencies, 0.99)),
+        },
+        "gemini_attempts": attempts,
+        "fallbacks": {kind[0]: count for kind, count in FALLBACKS.values().items()},
+        "mock": mock_stats,
+        # ru_maxrss is in KB on Linux; image workers are separate processes and not included
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "rss_growth_mb": round(rss_after - rss_before, 1) if rss_before is not None else None,
+        "loop_lag_ms": {
+            "p50": ms(percentile(lags, 0.5)),
+            "p99": ms(percentile(lags, 0.99)),
+            "max": ms(max(lags) if lags else None),
+        },
+        "cache_hit_check": cache_check,
+    }
+
+
+def print_report(report: dict):
+    print(f"\n{report['mode']} benchmark: {report['requests']} requests, concurrency {report['concurrency']}")
+    print(f"  duration        {report['duration_s']}s, {report['throughput_rps']} successful req/s")
+    print(f"  outcomes        {report['outcomes']}")
+    latency = report["latency_ms"]
+    print(f"  latency (ms)    p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}  max {latency['max']}")
+    print(f"  gemini attempts {report['gemini_attempts']}")
+    print(f"  fallbacks       {report['fallbacks']}")
+    print(f"  peak RSS        {report['peak_rss_mb']}MB (growth during run: {report['rss_growth_mb']}MB)")
+    lag = report["loop_lag_ms"]
+    print(f"  loop lag (ms)   p50 {lag['p50']}  p99 {lag['p99']}  max {lag['max']}")
+    check = report["cache_hit_check"]
+    if check is not None:
+        print(f"  cache hit check {'passed' if check['passed'] else 'FAILED'} ({check['outcome']} in "
+              f"{check['latency_ms']}ms, queue full: {check['queue_full']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark against a local mock Gemini server")
+    parser.add_argument("--mode", choices=("service", "post"), default="service",
+                        help="Drive AIService.generate_sticker directly, or the /post handler with stubbed Discord")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=0, help="Requests run before measuring")
+    parser.add_argument("--gemini-concurrency", type=int, help="Override GEMINI_MAX_CONCURRENCY for the run")
+    parser.add_argument("--guilds", type=int, default=3, help="Guilds the post-mode users are spread over")
+    parser.add_argument("--style", default="OOTD", help="Preset whose prompt is used")
+    parser.add_argument("--duplicates", action="store_true",
+                        help="Send identical requests (exercises coalescing and the cache)")
+    parser.add_argument("--cache", action="store_true", help="Enable the sticker cache (off by default)")
+    parser.add_argument("--check-cache-hit", action="store_true",
+                        help="Post mode: after the run, check a cached style is served while the queue is full")
+    parser.add_argument("--photo", help="Reference photo to use (default: generated noisy JPEG)")
+    parser.add_argument("--photo-width", type=int, default=3024)
+    parser.add_argument("--photo-height", type=int, default=4032)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--log-level", default="CRITICAL", help="Log level for the bot's own logs (default: quiet)")
+
+    mock_options = parser.add_argument_group("mock server")
+    mock_options.add_argument("--latency", type=float, default=1.0)
+    mock_options.add_argument("--latency-dist", choices=("fixed", "uniform", "lognormal"), default="fixed")
+    mock_options.add_argument("--latency-jitter", type=float, default=0.0)
+    mock_options.add_argument("--image-kb", type=int, default=1536, help="Returned image size before base64")
+    for kind in FAULTS:
+        mock_options.add_argument(f"--{kind.replace('_', '-')}-rate", type=float, default=0.0, dest=f"{kind}_rate")
+    mock_options.add_argument("--fault-models", default="", help="Comma-separated models faults apply to")
+    mock_options.add_argument("--hang-seconds", type=float, default=120)
+    mock_options.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    if args.photo:
+        from PIL import Image
+
+        with Image.open(args.photo) as image:
+            args.photo_width, args.photo_height = image.size
+    if args.style not in STICKER_PRESETS:
+        parser.error(f"Unknown style {args.style!r}")
+    if args.check_cache_hit:
+        if args.mode != "post" or not args.cache or args.style not in PRESET_CACHE_TTL:
+            parser.error("--check-cache-hit needs --mode post, --cache and a cached --style")
+
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    report = asyncio.run(benchmark(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    if report["cache_hit_check"] is not None and not report["cache_hit_check"]["passed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
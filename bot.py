@@ -1,13 +1,30 @@
+import time
+# Startup timing starts before the heavier imports below
+PROCESS_STARTED_AT = time.perf_counter()
+
 import discord
 import logging
 import asyncio
 import io
-import time
+from typing import Optional
 from discord import app_commands
 from discord.ext import commands
-from config import DISCORD_TOKEN
-from ai_service import AIService
+from config import (
+    DISCORD_TOKEN, MULTI_STYLE_CONCURRENCY, GEMINI_MAX_CONCURRENCY, QUEUE_MAX_DEPTH, QUEUE_MAX_PER_USER,
+    METRICS_HOST, METRICS_PORT, DOWNLOAD_MAX_BYTES, COMMAND_SYNC, COMMAND_SYNC_STATE_FILE,
+    GENERATION_BACKEND, JOB_QUEUE_PATH, JOB_POLL_SECONDS, JOB_LEASE_SECONDS, JOB_TIMEOUT_SECONDS,
+    DISCORD_AUTO_SHARD, DISCORD_SHARD_COUNT,
+)
+from ai_service import AIService, ImageTooLargeError, NonRetryableError
+from command_sync import sync_commands_if_changed
+from job_queue import JobQueue, RemoteGenerator
+from metrics import (
+    BYTES, CIRCUIT_STATE, HTTP_POOL, IN_FLIGHT, MODEL_ERROR_RATE, RATE_LIMIT_BLOCKED, REGISTRY, REQUESTS, SCHEDULER_JOBS,
+    STAGE_SECONDS, LoopLagMonitor, MetricsServer, StartupTimer,
+)
 from presets import STICKER_PRESETS
+from rate_limit import RateLimitError
+from scheduler import JobScheduler, QueueFullError
 
 # Configure logging
 logging.basicConfig(
@@ -15,24 +32,95 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger("viba_sticker_bot")
+startup = StartupTimer(PROCESS_STARTED_AT)
+startup.mark("imports")
+
+# AutoShardedBot runs several gateway shards in this process for large guild counts
+BotBase = commands.AutoShardedBot if DISCORD_AUTO_SHARD else commands.Bot
 
-class VibaStickerBot(commands.Bot):
+class VibaStickerBot(BotBase):
     def __init__(self):
         intents = discord.Intents.default()
         intents.messages = True
         intents.message_content = True
-        super().__init__(command_prefix="!", intents=intents)
+        options = {"shard_count": DISCORD_SHARD_COUNT} if DISCORD_AUTO_SHARD and DISCORD_SHARD_COUNT else {}
+        super().__init__(command_prefix="!", intents=intents, **options)
         self.ai_service = AIService()
+        # Generations run here (local) or in worker.py processes fed through the job queue
+        self.remote = None
+        if GENERATION_BACKEND == "queue":
+            self.remote = RemoteGenerator(JobQueue(JOB_QUEUE_PATH, lease_seconds=JOB_LEASE_SECONDS),
+                                          poll_interval=JOB_POLL_SECONDS, timeout=JOB_TIMEOUT_SECONDS)
+        self.generator = self.remote or self.ai_service
+        self.scheduler = JobScheduler(GEMINI_MAX_CONCURRENCY, QUEUE_MAX_DEPTH, QUEUE_MAX_PER_USER)
+        self.loop_lag = LoopLagMonitor()
+        self.metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT, self.health_report) if METRICS_PORT else None
+        REGISTRY.add_collector(self.collect_metrics)
 
     async def setup_hook(self):
-        await self.tree.sync()
-        logger.info("Synced slash commands.")
+        startup.mark("login")
+        self.loop_lag.start()
+        if self.metrics_server is not None:
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                logger.error(f"Could not start metrics endpoint on {METRICS_HOST}:{METRICS_PORT}: {e}")
+        startup.mark("metrics_server")
+        # Open Gemini/CDN connections while the command tree is checked (and synced only if it changed)
+        await asyncio.gather(
+            startup.timed("warm_up", self.ai_service.warm_up(gemini=self.remote is None)),
+            startup.timed("command_sync", sync_commands_if_changed(
+                self.tree, self.application_id, COMMAND_SYNC_STATE_FILE, COMMAND_SYNC)),
+        )
+        startup.mark("setup")
 
     async def on_ready(self):
         logger.info(f'Logged in as {self.user} (ID: {self.user.id})')
+        if not startup.reported:
+            startup.mark("gateway")
+            startup.reported = True
+            logger.info(startup.report())
         logger.info('------')
 
+    def collect_metrics(self):
+        """Refreshes point-in-time gauges before each /metrics scrape."""
+        stats = self.scheduler.stats()
+        SCHEDULER_JOBS.set(stats["queued"], state="queued")
+        SCHEDULER_JOBS.set(stats["running"], state="running")
+        circuit_values = {"closed": 0, "half_open": 1, "open": 2}
+        for model, health in self.ai_service.health_snapshot().items():
+            CIRCUIT_STATE.set(circuit_values.get(health["state"], 0), model=model)
+            MODEL_ERROR_RATE.set(health["error_rate"], model=model)
+        for model, limits in self.ai_service.rate_limiter.snapshot().items():
+            RATE_LIMIT_BLOCKED.set(limits["blocked_for"], model=model)
+        IN_FLIGHT.set(self.ai_service.inflight_stats()["generations"], stage="generation")
+        for pool, pool_stats in self.ai_service.pool_stats().items():
+            for state, value in pool_stats.items():
+                HTTP_POOL.set(value, pool=pool, state=state)
+
+    def health_report(self) -> dict:
+        service = self.ai_service
+        return {
+            "ready": self.is_ready(),
+            "latency": None if self.latency != self.latency else round(self.latency, 3),  # NaN before connect
+            "loop_lag": round(self.loop_lag.last_lag, 4),
+            "startup": {**startup.phases, **startup.steps},
+            "scheduler": self.scheduler.stats(),
+            "models": service.health_snapshot(),
+            "rate_limits": service.rate_limiter.snapshot(),
+            "http_pools": service.pool_stats(),
+            "hedging": {"requests": service.hedge_budget.requests, "hedged": service.hedge_budget.hedged},
+            "coalesced": service.inflight_stats()["coalesced"],
+            "cache": {"hits": service.cache.hits, "misses": service.cache.misses} if service.cache else None,
+            "job_queue": self.remote.stats() if self.remote else None,
+        }
+
     async def close(self):
+        self.loop_lag.stop()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        if self.remote is not None:
+            self.remote.close()
         await self.ai_service.close()
         await super().close()
 
@@ -47,6 +135,7 @@ class VibaStickerBot(commands.Bot):
             return
 
 client = VibaStickerBot()
+startup.mark("init")
 
 # Prepare choices from presets
 STYLE_CHOICES = [
@@ -54,31 +143,108 @@ STYLE_CHOICES = [
     for name in STICKER_PRESETS.keys()
 ]
 
-async def send_progress_update(interaction: discord.Interaction):
-    """Sends a progress update if generation takes too long."""
-    try:
-        await asyncio.sleep(15)
-        # Check if the interaction is still valid and not already replied to with the final result
-        await interaction.followup.send("⏳ Still processing your sticker, thank you for your patience!", ephemeral=True)
-    except asyncio.CancelledError:
-        pass
-    except Exception as e:
-        logger.debug(f"Progress update skipped: {e}")
+ALL_STYLES = "All styles"
+MULTI_STYLE_CHOICES = [app_commands.Choice(name=ALL_STYLES, value=ALL_STYLES)] + STYLE_CHOICES
+
+class StatusMessage:
+    """Keeps the deferred response updated in place, throttled to stay clear of edit rate limits."""
+
+    def __init__(self, interaction: discord.Interaction, min_interval: float = 3.0):
+        self.interaction = interaction
+        self.min_interval = min_interval
+        self._content = None
+        self._shown = None
+        self._last_edit = 0.0
+        self._task = None
+
+    def set(self, content: str):
+        self._content = content
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        try:
+            while self._content != self._shown:
+                delay = self._last_edit + self.min_interval - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                content = self._content
+                self._last_edit = time.time()
+                await self.interaction.edit_original_response(content=content)
+                self._shown = content
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.debug(f"Status update skipped: {e}")
+
+    def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+def scheduler_gate(interaction: discord.Interaction, on_update):
+    """Gate for AIService that runs the upstream generation as a job in the fair scheduler."""
+    def gate(factory):
+        return client.scheduler.submit(interaction.user.id, interaction.guild_id, factory, on_update=on_update)
+    return gate
+
+def queue_status_text(position: int, eta: float) -> str:
+    if position == 0:
+        return "🎨 Generating..."
+    return f"⏳ #{position} in the queue, starting in about {eta:.0f}s"
+
+def request_outcome(e: Exception) -> str:
+    """Outcome label for the requests metric."""
+    if isinstance(e, QueueFullError):
+        return "queue_full"
+    if isinstance(e, RateLimitError):
+        return "rate_limited"
+    if isinstance(e, NonRetryableError):
+        return "rejected"
+    return "error"
+
+def validate_photo(photo: discord.Attachment) -> Optional[str]:
+    """Returns an error message if the attachment cannot be used, before anything is downloaded."""
+    if not photo.content_type or not photo.content_type.startswith('image/'):
+        return "❌ Please upload a valid image file!"
+    if photo.size > DOWNLOAD_MAX_BYTES:
+        return f"❌ That image is too large ({photo.size/1024/1024:.1f}MB). Please upload one under {DOWNLOAD_MAX_BYTES/1024/1024:.0f}MB."
+    return None
+
+async def download_photo(photo: discord.Attachment) -> bytes:
+    return await client.ai_service.download_attachment(
+        photo.url, size=photo.size, proxy_url=photo.proxy_url, width=photo.width, height=photo.height
+    )
+
+def describe_generation_error(e: Exception) -> str:
+    """User-facing message for a failed generation."""
+    if isinstance(e, QueueFullError):
+        return f"⏳ {e}"
+    if isinstance(e, ImageTooLargeError):
+        return f"❌ That image is too large. {e}."
+    if isinstance(e, RateLimitError):
+        if e.retry_after:
+            return f"❌ Rate limit exceeded. Please try again in about {max(1, round(e.retry_after))}s."
+        return "❌ Rate limit exceeded. Please try again later."
+    if "blocked" in str(e).lower():
+        return "❌ Image generation was blocked by safety filters. Please try another image."
+    return f"❌ Generation failed. Error: {str(e)}"
 
 @client.tree.command(name="post", description="Upload a photo and choose a style to generate a sticker")
 @app_commands.describe(photo="Please upload your photo", style="Please choose a style")
 @app_commands.choices(style=STYLE_CHOICES)
 async def post(interaction: discord.Interaction, photo: discord.Attachment, style: app_commands.Choice[str]):
     # Validation
-    if not photo.content_type or not photo.content_type.startswith('image/'):
-        await interaction.response.send_message("❌ Please upload a valid image file!", ephemeral=True)
+    invalid_reason = validate_photo(photo)
+    if invalid_reason:
+        REQUESTS.inc(command="post", outcome="invalid")
+        await interaction.response.send_message(invalid_reason, ephemeral=True)
         return
 
     # Defer the response since generation takes time
     await interaction.response.defer(thinking=True)
     
-    # Start progress update task
-    progress_task = asyncio.create_task(send_progress_update(interaction))
+    # Queue position / progress is shown by editing the deferred response
+    status = StatusMessage(interaction)
     
     start_time = time.time()
     try:
@@ -92,47 +258,175 @@ async def post(interaction: discord.Interaction, photo: discord.Attachment, styl
 
         # 1. Download Image
         logger.info(f"Downloading image from {photo.url}...")
-        image_bytes = await client.ai_service.download_image(photo.url)
+        image_bytes = await download_photo(photo)
         download_time = time.time() - start_time
         
-        # 2. Generate Sticker
+        # 2. Generate Sticker (the Gemini call is queued behind other users' jobs if Gemini is busy)
         logger.info(f"Generating sticker with style: {selected_style_name}")
         gen_start = time.time()
-        generated_image_bytes = await client.ai_service.generate_sticker(sticker_prompt, image_bytes, photo.content_type)
+        generated_image_bytes = await client.generator.generate_sticker(
+            sticker_prompt, image_bytes, photo.content_type, style_name=selected_style_name,
+            gate=scheduler_gate(interaction, lambda position, eta: status.set(queue_status_text(position, eta))),
+        )
         gen_time = time.time() - gen_start
+        status.stop()
         
         # 3. Send Result
         logger.info(f"Sending result... (Total time: {time.time() - start_time:.2f}s)")
-        with io.BytesIO(generated_image_bytes) as image_file:
+        with io.BytesIO(generated_image_bytes) as image_file, STAGE_SECONDS.time(stage="discord_upload"):
             image_file.seek(0)
             file = discord.File(image_file, filename="sticker.png")
-            await interaction.followup.send(
+            await interaction.edit_original_response(
                 content=f"✨ **{selected_style_name}** sticker generated!\nSubmitted by {interaction.user.mention}", 
-                file=file
+                attachments=[file]
             )
+        BYTES.inc(len(generated_image_bytes), direction="out", kind="discord")
+        STAGE_SECONDS.observe(time.time() - start_time, stage="total")
+        REQUESTS.inc(command="post", outcome="success")
         
         logger.info(f"Task completed successfully. (DL: {download_time:.2f}s, AI: {gen_time:.2f}s)")
 
     except Exception as e:
+        REQUESTS.inc(command="post", outcome=request_outcome(e))
         logger.error(f"Error processing slash command: {e}")
-        error_message = f"❌ Generation failed. Error: {str(e)}"
-        if "429" in str(e):
-            error_message = "❌ Rate limit exceeded. Please try again later."
-        elif "blocked" in str(e).lower():
-            error_message = "❌ Image generation was blocked by safety filters. Please try another image."
+        error_message = describe_generation_error(e)
+        status.stop()
         
         try:
-            await interaction.followup.send(content=error_message)
+            await interaction.edit_original_response(content=error_message)
+        except:
+            pass
+
+@client.tree.command(name="post_multi", description="Upload a photo and generate stickers in several styles at once")
+@app_commands.describe(
+    photo="Please upload your photo",
+    style_1="First style, or All styles",
+    style_2="Another style (optional)",
+    style_3="Another style (optional)",
+    style_4="Another style (optional)",
+)
+@app_commands.choices(style_1=MULTI_STYLE_CHOICES, style_2=STYLE_CHOICES, style_3=STYLE_CHOICES, style_4=STYLE_CHOICES)
+async def post_multi(
+    interaction: discord.Interaction,
+    photo: discord.Attachment,
+    style_1: app_commands.Choice[str],
+    style_2: Optional[app_commands.Choice[str]] = None,
+    style_3: Optional[app_commands.Choice[str]] = None,
+    style_4: Optional[app_commands.Choice[str]] = None,
+):
+    # Validation
+    invalid_reason = validate_photo(photo)
+    if invalid_reason:
+        REQUESTS.inc(command="post_multi", outcome="invalid")
+        await interaction.response.send_message(invalid_reason, ephemeral=True)
+        return
+
+    if style_1.value == ALL_STYLES:
+        style_names = list(STICKER_PRESETS.keys())
+    else:
+        # Keep the user's order, drop duplicates
+        style_names = list(dict.fromkeys(s.value for s in (style_1, style_2, style_3, style_4) if s))
+
+    await interaction.response.defer(thinking=True)
+    status = StatusMessage(interaction)
+    style_states = {name: "⏳ waiting" for name in style_names}
+
+    def show_states():
+        status.set("\n".join(f"**{name}**: {state}" for name, state in style_states.items()))
+
+    def on_style_update(style_name: str, position: int, eta: float):
+        style_states[style_name] = queue_status_text(position, eta)
+        show_states()
+
+    start_time = time.time()
+    try:
+        # 1. Download and optimize the photo once for every style (queue workers optimize their own copy)
+        logger.info(f"Downloading image from {photo.url} for {len(style_names)} styles...")
+        image_bytes = await download_photo(photo)
+        optimized = None
+        if client.remote is None:
+            optimized = await client.ai_service.optimize_image(image_bytes, photo.content_type)
+        prep_time = time.time() - start_time
+    except Exception as e:
+        REQUESTS.inc(command="post_multi", outcome=request_outcome(e))
+        logger.error(f"Error preparing multi-style request: {e}")
+        try:
+            await interaction.edit_original_response(content=describe_generation_error(e))
         except:
             pass
+        return
+
+    # 2. Generate the styles concurrently, capped per request and queued fairly with everyone else
+    semaphore = asyncio.Semaphore(MULTI_STYLE_CONCURRENCY)
+    show_states()
+
+    def generate(style_name: str):
+        gate = scheduler_gate(interaction, lambda position, eta: on_style_update(style_name, position, eta))
+        if optimized is None:
+            return client.remote.generate_sticker(
+                STICKER_PRESETS[style_name], image_bytes, photo.content_type, style_name=style_name,
+                reuse_reference=len(style_names) > 1, gate=gate,
+            )
+        return client.ai_service.generate_from_reference(
+            STICKER_PRESETS[style_name], optimized, style_name=style_name, reuse_reference=len(style_names) > 1,
+            gate=gate,
+        )
+
+    async def generate_style(style_name: str):
+        async with semaphore:
+            try:
+                result = await generate(style_name)
+                style_states[style_name] = "✅ done"
+                return style_name, result, None
+            except Exception as e:
+                REQUESTS.inc(command="post_multi", outcome=request_outcome(e))
+                logger.error(f"Style {style_name} failed: {e}")
+                style_states[style_name] = "❌ failed"
+                return style_name, None, e
+            finally:
+                show_states()
+
+    # 3. Send each result as soon as it is ready
+    succeeded = 0
+    try:
+        for next_done in asyncio.as_completed([generate_style(name) for name in style_names]):
+            style_name, generated_image_bytes, error = await next_done
+            try:
+                if error is not None:
+                    await interaction.followup.send(content=f"**{style_name}**: {describe_generation_error(error)}")
+                    continue
+                with io.BytesIO(generated_image_bytes) as image_file, STAGE_SECONDS.time(stage="discord_upload"):
+                    file = discord.File(image_file, filename="sticker.png")
+                    await interaction.followup.send(
+                        content=f"✨ **{style_name}** sticker generated!\nSubmitted by {interaction.user.mention}",
+                        file=file
+                    )
+                BYTES.inc(len(generated_image_bytes), direction="out", kind="discord")
+                REQUESTS.inc(command="post_multi", outcome="success")
+                succeeded += 1
+            except Exception as e:
+                logger.error(f"Failed to deliver {style_name} sticker: {e}")
     finally:
-        # Cancel progress task if it's still running
-        if not progress_task.done():
-            progress_task.cancel()
+        status.stop()
+
+    try:
+        await interaction.edit_original_response(
+            content=f"✨ {succeeded}/{len(style_names)} styles generated for {interaction.user.mention}"
+        )
+    except Exception as e:
+        logger.debug(f"Final status update skipped: {e}")
+
+    STAGE_SECONDS.observe(time.time() - start_time, stage="total_multi")
+    logger.info(f"Multi-style task finished: {succeeded}/{len(style_names)} styles "
+                f"(prep: {prep_time:.2f}s, total: {time.time() - start_time:.2f}s)")
 
 if __name__ == "__main__":
     if not DISCORD_TOKEN:
         logger.error("DISCORD_TOKEN is missing in environment variables.")
         exit(1)
-        
+
+    # Fork image workers while the process is still single-threaded; login already runs DNS in threads
+    if client.remote is None:
+        client.ai_service.image_pipeline.start()
+        startup.mark("image_workers")
     client.run(DISCORD_TOKEN)
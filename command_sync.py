@@ -0,0 +1,65 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def command_tree_fingerprint(tree, application_id=None) -> str:
+    """SHA-256 over the JSON payload Discord would receive for the global command tree."""
+    payload = []
+    for command in tree.get_commands():
+        try:
+            payload.append(command.to_dict(tree))
+        except TypeError:
+            # discord.py < 2.4 takes no tree argument
+            payload.append(command.to_dict())
+    payload.sort(key=lambda c: (c.get("type", 1), c.get("name", "")))
+    body = json.dumps({"application_id": application_id, "commands": payload}, sort_keys=True, default=str)
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+def _read_state(path: str) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_state(path: str, state: dict):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+async def sync_commands_if_changed(tree, application_id, state_path: str, mode: str = "auto") -> bool:
+    """
+    Syncs the global command tree only when its fingerprint differs from the last sync.
+
+    mode is "auto" (compare fingerprints), "always" or "off". Returns True if a
+    sync was sent to Discord.
+    """
+    if mode == "off":
+        logger.info("Slash command sync disabled (COMMAND_SYNC=off).")
+        return False
+
+    fingerprint = command_tree_fingerprint(tree, application_id)
+    if mode != "always" and _read_state(state_path).get("fingerprint") == fingerprint:
+        logger.info(f"Slash commands unchanged ({fingerprint[:12]}), skipping sync.")
+        return False
+
+    await tree.sync()
+    try:
+        _write_state(state_path, {"fingerprint": fingerprint, "application_id": application_id,
+                                  "synced_at": time.time()})
+    except OSError as e:
+        logger.warning(f"Could not record command sync state in {state_path}: {e}")
+    logger.info(f"Synced slash commands ({fingerprint[:12]}).")
+    return True
@@ -6,12 +6,124 @@ load_dotenv()
 
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# Point at a local stand-in server (see mock_gemini.py) to run without real quota
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip("/")
 
 # Model names
 GEMINI_TEXT_MODEL = os.getenv("GEMINI_TEXT_MODEL", "gemini-3-pro-preview")
 GEMINI_IMAGE_MODEL = os.getenv("GEMINI_IMAGE_MODEL", "gemini-3.1-flash-image-preview")
 GEMINI_IMAGE_MODEL_FALLBACK = os.getenv("GEMINI_IMAGE_MODEL_FALLBACK", "gemini-2.5-flash-image")
 
+# Reference image transport: "off" always sends it inline, "auto" uploads it to the
+# Files API when it will be reused (multi-style) or a URI is already cached, "always"
+# uploads every reference. Cached URIs are reused for GEMINI_FILE_URI_TTL seconds.
+GEMINI_FILE_UPLOAD = os.getenv("GEMINI_FILE_UPLOAD", "auto").lower()
+GEMINI_FILE_URI_TTL = float(os.getenv("GEMINI_FILE_URI_TTL", "3600"))
+
+# Job scheduler: concurrent generations sent to Gemini, maximum waiting jobs,
+# and maximum queued + running jobs per user
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+QUEUE_MAX_DEPTH = int(os.getenv("QUEUE_MAX_DEPTH", "50"))
+QUEUE_MAX_PER_USER = int(os.getenv("QUEUE_MAX_PER_USER", "6"))
+
+# Client-side quotas per model (requests / tokens per minute, 0 = unlimited).
+# Requests wait up to RATE_LIMIT_MAX_WAIT_SECONDS for capacity (or for a 429's
+# Retry-After to pass) before failing with a rate-limit error.
+GEMINI_IMAGE_MODEL_RPM = float(os.getenv("GEMINI_IMAGE_MODEL_RPM", "0"))
+GEMINI_IMAGE_MODEL_TPM = float(os.getenv("GEMINI_IMAGE_MODEL_TPM", "0"))
+GEMINI_IMAGE_MODEL_FALLBACK_RPM = float(os.getenv("GEMINI_IMAGE_MODEL_FALLBACK_RPM", "0"))
+GEMINI_IMAGE_MODEL_FALLBACK_TPM = float(os.getenv("GEMINI_IMAGE_MODEL_FALLBACK_TPM", "0"))
+GEMINI_MODEL_QUOTAS = {
+    GEMINI_IMAGE_MODEL: (GEMINI_IMAGE_MODEL_RPM, GEMINI_IMAGE_MODEL_TPM),
+    GEMINI_IMAGE_MODEL_FALLBACK: (GEMINI_IMAGE_MODEL_FALLBACK_RPM, GEMINI_IMAGE_MODEL_FALLBACK_TPM),
+}
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("RATE_LIMIT_MAX_WAIT_SECONDS", "5"))
+
+# Styles generated concurrently for a single multi-style /post_multi request
+MULTI_STYLE_CONCURRENCY = int(os.getenv("MULTI_STYLE_CONCURRENCY", "3"))
+
+# Generation backend: "local" runs generations in the bot process; "queue" hands
+# them to worker.py processes through the SQLite job queue at JOB_QUEUE_PATH
+# (which must be on storage shared with the workers).
+GENERATION_BACKEND = os.getenv("GENERATION_BACKEND", "local").lower()
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", ".cache/jobs.sqlite3")
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "0.25"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_TIMEOUT_SECONDS = float(os.getenv("JOB_TIMEOUT_SECONDS", "300"))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))
+
+# Gateway sharding: DISCORD_AUTO_SHARD uses AutoShardedBot; DISCORD_SHARD_COUNT
+# fixes the shard count (0 = as recommended by Discord)
+DISCORD_AUTO_SHARD = os.getenv("DISCORD_AUTO_SHARD", "false").lower() in ("1", "true", "yes")
+DISCORD_SHARD_COUNT = int(os.getenv("DISCORD_SHARD_COUNT", "0"))
+
+# Slash command sync: auto (only when the command tree fingerprint changes), always, or off.
+# The last synced fingerprint is kept in COMMAND_SYNC_STATE_FILE.
+COMMAND_SYNC = os.getenv("COMMAND_SYNC", "auto").lower()
+COMMAND_SYNC_STATE_FILE = os.getenv("COMMAND_SYNC_STATE_FILE", ".cache/command_sync.json")
+
+# Prometheus-style /metrics and JSON /health endpoint (port 0 disables it)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# HTTP connection pools: one for Gemini, one for attachment/CDN downloads.
+# Pools are warmed at startup and re-probed every HTTP_WARM_INTERVAL_SECONDS
+# while idle (0 disables the keep-warm probes).
+GEMINI_POOL_LIMIT = int(os.getenv("GEMINI_POOL_LIMIT", "32"))
+GEMINI_POOL_LIMIT_PER_HOST = int(os.getenv("GEMINI_POOL_LIMIT_PER_HOST", "16"))
+DOWNLOAD_POOL_LIMIT = int(os.getenv("DOWNLOAD_POOL_LIMIT", "32"))
+DOWNLOAD_POOL_LIMIT_PER_HOST = int(os.getenv("DOWNLOAD_POOL_LIMIT_PER_HOST", "8"))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "60"))
+HTTP_DNS_CACHE_SECONDS = int(os.getenv("HTTP_DNS_CACHE_SECONDS", "300"))
+HTTP_WARM_CONNECTIONS = int(os.getenv("HTTP_WARM_CONNECTIONS", "2"))
+HTTP_WARM_INTERVAL_SECONDS = float(os.getenv("HTTP_WARM_INTERVAL_SECONDS", "45"))
+
+# Attachment downloads: larger bodies are rejected before/while streaming.
+# With DOWNLOAD_RESIZED, large attachments are fetched from Discord's media
+# proxy already scaled down to IMAGE_MAX_DIMENSION.
+DOWNLOAD_MAX_BYTES = int(os.getenv("DOWNLOAD_MAX_MB", "20")) * 1024 * 1024
+DOWNLOAD_RESIZED = os.getenv("DOWNLOAD_RESIZED", "true").lower() in ("1", "true", "yes")
+
+# Image preprocessing (0 workers = one per CPU this process may run on, at most 4).
+# os.cpu_count() reports the host's cores, not the container's; every worker is a fork of the whole process.
+_USABLE_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "0")) or min(_USABLE_CPUS, 4)
+IMAGE_MAX_PENDING = int(os.getenv("IMAGE_MAX_PENDING", str(IMAGE_WORKERS * 4)))
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1024"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+# JPEGs already within IMAGE_MAX_DIMENSION and below this size are sent without re-encoding
+IMAGE_PASSTHROUGH_MAX_BYTES = int(os.getenv("IMAGE_PASSTHROUGH_MAX_BYTES", str(300 * 1024)))
+
+# Sticker result cache (per-preset TTLs live in presets.PRESET_CACHE_TTL)
+STICKER_CACHE_ENABLED = os.getenv("STICKER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+STICKER_CACHE_DIR = os.getenv("STICKER_CACHE_DIR", ".cache/stickers")
+STICKER_CACHE_MEMORY_BYTES = int(os.getenv("STICKER_CACHE_MEMORY_MB", "64")) * 1024 * 1024
+STICKER_CACHE_DISK_BYTES = int(os.getenv("STICKER_CACHE_DISK_MB", "1024")) * 1024 * 1024
+
+# Hedged requests: start the fallback model alongside a slow primary call.
+# The delay follows the primary model's observed HEDGE_PERCENTILE latency once
+# HEDGE_MIN_SAMPLES successes are recorded, and HEDGE_MAX_RATIO caps the share
+# of requests that may be hedged.
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "true").lower() in ("1", "true", "yes")
+HEDGE_DELAY_SECONDS = float(os.getenv("HEDGE_DELAY_SECONDS", "12"))
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", "4"))
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.9"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.25"))
+
+# Adaptive per-model timeouts: percentile of recent successful latencies times a
+# multiplier, clamped to [min, max]. Built-in defaults apply until enough samples exist.
+MODEL_TIMEOUT_PERCENTILE = float(os.getenv("MODEL_TIMEOUT_PERCENTILE", "0.95"))
+MODEL_TIMEOUT_MULTIPLIER = float(os.getenv("MODEL_TIMEOUT_MULTIPLIER", "1.5"))
+MODEL_TIMEOUT_MIN_SECONDS = float(os.getenv("MODEL_TIMEOUT_MIN_SECONDS", "8"))
+MODEL_TIMEOUT_MAX_SECONDS = float(os.getenv("MODEL_TIMEOUT_MAX_SECONDS", "30"))
+
+# Circuit breaker: skip a model once its recent error rate or consecutive
+# failures cross these limits, probing again after the cooldown.
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_CONSECUTIVE_FAILURES = int(os.getenv("CIRCUIT_CONSECUTIVE_FAILURES", "4"))
+CIRCUIT_COOLDOWN_SECONDS = float(os.getenv("CIRCUIT_COOLDOWN_SECONDS", "30"))
+
 if not DISCORD_TOKEN:
     print("Warning: DISCORD_TOKEN is not set.")
 
@@ -0,0 +1,103 @@
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class FileUploader:
+    """
+    Uploads reference images to the Gemini Files API and remembers their URIs.
+
+    Uploaded files live for 48 hours upstream; URIs are reused for a much
+    shorter `ttl` keyed on the SHA-256 of the image bytes, so re-posts of the
+    same photo and multi-style requests skip the upload. Concurrent uploads of
+    the same bytes are coalesced.
+    """
+
+    def __init__(self, get_session, api_key: str, upload_url: str, ttl: float = 3600, max_entries: int = 512):
+        self._get_session = get_session
+        self.api_key = api_key
+        self.upload_url = upload_url
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._uris = OrderedDict()  # sha256 -> (uri, expires_at)
+        self._uploads = SingleFlight()
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def cached_uri(self, data: bytes, digest: str = None):
+        """Returns a still-valid URI for these bytes without uploading, or None."""
+        digest = digest or self.digest(data)
+        entry = self._uris.get(digest)
+        if entry is None:
+            return None
+        uri, expires_at = entry
+        if time.time() >= expires_at:
+            del self._uris[digest]
+            return None
+        self._uris.move_to_end(digest)
+        return uri
+
+    def invalidate(self, uri: str):
+        for digest, (cached_uri, _) in list(self._uris.items()):
+            if cached_uri == uri:
+                del self._uris[digest]
+
+    async def get_uri(self, data: bytes, mime_type: str) -> str:
+        """Returns the file URI for these bytes, uploading them if no valid URI is cached."""
+        digest = self.digest(data)
+        uri = self.cached_uri(data, digest)
+        if uri is not None:
+            return uri
+        return await self._uploads.do(digest, lambda: self._upload(data, mime_type, digest))
+
+    async def _upload(self, data: bytes, mime_type: str, digest: str) -> str:
+        session = await self._get_session()
+        timeout = aiohttp.ClientTimeout(total=30)
+        start_time = time.time()
+
+        # Resumable upload: start the session, then send the bytes and finalize
+        start_headers = {
+            "X-Goog-Upload-Protocol": "resumable",
+            "X-Goog-Upload-Command": "start",
+            "X-Goog-Upload-Header-Content-Length": str(len(data)),
+            "X-Goog-Upload-Header-Content-Type": mime_type,
+        }
+        metadata = {"file": {"display_name": f"viba-reference-{digest[:16]}"}}
+        async with session.post(f"{self.upload_url}?key={self.api_key}", json=metadata,
+                                headers=start_headers, timeout=timeout) as response:
+            if response.status != 200:
+                text = await response.text()
+                raise Exception(f"File upload start failed: {response.status} {text[:500]}")
+            session_url = response.headers.get("X-Goog-Upload-URL")
+        if not session_url:
+            raise Exception("File upload start returned no upload URL")
+
+        upload_headers = {
+            "Content-Length": str(len(data)),
+            "X-Goog-Upload-Offset": "0",
+            "X-Goog-Upload-Command": "upload, finalize",
+        }
+        async with session.post(session_url, data=data, headers=upload_headers, timeout=timeout) as response:
+            if response.status != 200:
+                text = await response.text()
+                raise Exception(f"File upload failed: {response.status} {text[:500]}")
+            info = await response.json()
+
+        uri = info.get("file", {}).get("uri")
+        if not uri:
+            raise Exception(f"File upload returned no URI: {str(info)[:500]}")
+
+        self._uris[digest] = (uri, time.time() + self.ttl)
+        while len(self._uris) > self.max_entries:
+            self._uris.popitem(last=False)
+        logger.info(f"Uploaded reference image ({len(data)/1024:.1f}KB) in {time.time() - start_time:.2f}s: {uri}")
+        return uri
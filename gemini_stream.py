@@ -0,0 +1,249 @@
+import binascii
+import json
+import re
+
+_STRING_STOP = re.compile(rb'["\\]')
+_WHITESPACE = b" \t\r\n"
+_SIMPLE_ESCAPES = {ord("/"): b"/", ord("\\"): b"\\", ord('"'): b'"'}
+
+# Longest text field (escaped form) kept from a response
+MAX_CAPTURE_BYTES = 64 * 1024
+
+
+def truncate(text, limit: int = 500) -> str:
+    """Shortens a payload for logging."""
+    text = str(text)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}... ({len(text)} chars total)"
+
+
+class _Frame:
+    __slots__ = ("is_object", "key", "index", "expect_key")
+
+    def __init__(self, is_object: bool):
+        self.is_object = is_object
+        self.key = None
+        self.index = 0
+        self.expect_key = is_object
+
+
+class GenerateContentParser:
+    """
+    Incremental parser for a generateContent response body.
+
+    Feed it raw body chunks as they arrive. The first candidate's first
+    inlineData/inline_data image is base64-decoded chunk by chunk into a single
+    buffer, so the encoded text and the parsed JSON tree are never held in
+    memory. Only small fields are kept: text parts, finishReason,
+    promptFeedback.blockReason and the key names of each part.
+    """
+
+    def __init__(self):
+        self._stack = []
+        self._carry = b""
+        self._total_bytes = 0
+
+        # Current string state
+        self._in_string = False
+        self._string_kind = None  # "key", "image", "capture" or "skip"
+        self._string_path = None
+        self._capture = None
+        self._b64_pending = bytearray()
+
+        self._image = None
+        self.image_mime_type = None
+        self.has_candidates = False
+        self.texts = []
+        self.block_reason = None
+        self.finish_reason = None
+        self.part_keys = []
+        self.error = None
+
+    # --- public API ---
+
+    def feed(self, chunk: bytes):
+        self._total_bytes += len(chunk)
+        data = self._carry + chunk if self._carry else chunk
+        self._carry = b""
+        i = 0
+        n = len(data)
+        while i < n:
+            if self._in_string:
+                i = self._scan_string(data, i)
+                continue
+            c = data[i]
+            if c in _WHITESPACE:
+                pass
+            elif c == 0x22:  # "
+                self._start_string()
+            elif c == 0x7B:  # {
+                self._start_value()
+                self._stack.append(_Frame(True))
+            elif c == 0x5B:  # [
+                self._start_value()
+                self._stack.append(_Frame(False))
+            elif c in (0x7D, 0x5D):  # } ]
+                if self._stack:
+                    self._stack.pop()
+            elif c == 0x3A:  # :
+                if self._stack:
+                    self._stack[-1].expect_key = False
+            elif c == 0x2C:  # ,
+                if self._stack:
+                    top = self._stack[-1]
+                    if top.is_object:
+                        top.expect_key = True
+                        top.key = None
+                    else:
+                        top.index += 1
+            # Anything else belongs to a number/true/false/null, none of which we need
+            i += 1
+
+    def image(self):
+        """
+        Returns the decoded image, or None if the response had no inline image.
+
+        The bytearray is handed over rather than copied, so a multi-MB image is
+        not held twice; the parser must not be fed afterwards.
+        """
+        if self._image is None:
+            return None
+        if self._b64_pending:
+            # Tolerate a missing trailing pad
+            pending = bytes(self._b64_pending) + b"=" * (-len(self._b64_pending) % 4)
+            self._b64_pending.clear()
+            self._image += binascii.a2b_base64(pending)
+        image, self._image = self._image, None
+        return image
+
+    def summary(self) -> dict:
+        """Small description of the response, safe to log."""
+        return {
+            "bytes": self._total_bytes,
+            "has_candidates": self.has_candidates,
+            "finish_reason": self.finish_reason,
+            "block_reason": self.block_reason,
+            "part_keys": self.part_keys,
+            "texts": [truncate(text, 200) for text in self.texts],
+            "error": truncate(self.error, 200) if self.error else None,
+        }
+
+    # --- internals ---
+
+    def _path(self):
+        return [frame.key if frame.is_object else frame.index for frame in self._stack]
+
+    def _start_value(self):
+        path = self._path()
+        if len(path) >= 2 and path[0] == "candidates" and path[1] == 0:
+            self.has_candidates = True
+        # An object opening at candidates[0].content.parts[j]
+        if len(path) == 5 and path[0] == "candidates" and path[1] == 0 and path[3] == "parts":
+            while len(self.part_keys) <= path[4]:
+                self.part_keys.append([])
+
+    def _start_string(self):
+        self._in_string = True
+        top = self._stack[-1] if self._stack else None
+        if top is not None and top.is_object and top.expect_key:
+            self._string_kind = "key"
+            self._capture = bytearray()
+            return
+
+        self._start_value()
+        path = self._path()
+        self._string_path = path
+        if (self._image is None and len(path) == 7
+                and path[:3] == ["candidates", 0, "content"] and path[3] == "parts"
+                and path[5] in ("inlineData", "inline_data") and path[6] == "data"):
+            self._string_kind = "image"
+            self._image = bytearray()
+            return
+
+        if path and path[-1] in ("text", "blockReason", "finishReason", "mimeType", "mime_type", "message"):
+            self._string_kind = "capture"
+            self._capture = bytearray()
+        else:
+            self._string_kind = "skip"
+
+    def _scan_string(self, data: bytes, i: int) -> int:
+        kind = self._string_kind
+        while True:
+            match = _STRING_STOP.search(data, i)
+            end = match.start() if match else len(data)
+            if end > i:
+                self._append_string(data[i:end], kind)
+            if match is None:
+                return len(data)
+            if data[end] == 0x22:  # closing quote
+                self._end_string()
+                return end + 1
+
+            # Backslash escape; carry it over if it is split across chunks
+            if end + 1 >= len(data) or (data[end + 1] == 0x75 and end + 6 > len(data)):
+                self._carry = data[end:]
+                return len(data)
+            escape = data[end + 1]
+            if escape == 0x75:  # \uXXXX
+                raw = data[end:end + 6]
+                i = end + 6
+            else:
+                raw = data[end:end + 2]
+                i = end + 2
+
+            if kind == "image":
+                if escape in _SIMPLE_ESCAPES:
+                    self._append_string(_SIMPLE_ESCAPES[escape], kind)
+                # \n, \r etc. inside base64 are line wrapping and carry no data
+            elif kind != "skip":
+                # Key and captured strings keep their escaped form and are decoded by json at the end
+                self._append_string(raw, kind)
+
+    def _append_string(self, segment: bytes, kind: str):
+        if kind == "image":
+            pending = self._b64_pending
+            pending += segment
+            usable = len(pending) - len(pending) % 4
+            if usable:
+                self._image += binascii.a2b_base64(bytes(pending[:usable]))
+                del pending[:usable]
+        elif kind in ("key", "capture"):
+            if len(self._capture) < MAX_CAPTURE_BYTES:
+                self._capture += segment[:MAX_CAPTURE_BYTES - len(self._capture)]
+
+    def _end_string(self):
+        kind = self._string_kind
+        self._in_string = False
+        self._string_kind = None
+        if kind == "key":
+            key = self._decode_capture()
+            top = self._stack[-1]
+            top.key = key
+            parent = self._path()[:-1]
+            if len(parent) == 5 and parent[:4] == ["candidates", 0, "content", "parts"] and parent[4] < len(self.part_keys):
+                self.part_keys[parent[4]].append(key)
+        elif kind == "capture":
+            self._store_capture(self._string_path, self._decode_capture())
+        self._capture = None
+
+    def _decode_capture(self) -> str:
+        raw = bytes(self._capture)
+        try:
+            return json.loads(b'"' + raw + b'"')
+        except ValueError:
+            return raw.decode("utf-8", errors="replace")
+
+    def _store_capture(self, path, value: str):
+        field = path[-1]
+        if field == "text" and len(path) == 6 and path[:4] == ["candidates", 0, "content", "parts"]:
+            self.texts.append(value)
+        elif field == "finishReason" and path[:2] == ["candidates", 0]:
+            self.finish_reason = value
+        elif field == "blockReason" and path[0] == "promptFeedback":
+            self.block_reason = value
+        elif field in ("mimeType", "mime_type") and len(path) == 7 and path[5] in ("inlineData", "inline_data"):
+            if self.image_mime_type is None:
+                self.image_mime_type = value
+        elif field == "message" and path[0] == "error":
+            self.error = value
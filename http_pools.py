@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class HttpPool:
+    """
+    One aiohttp session with an explicitly sized, keep-alive connector for one upstream.
+
+    `warm()` opens connections ahead of the first user request by sending
+    lightweight probes to `probe_urls`, so DNS, TCP and TLS setup stay off
+    the user-visible path.
+    """
+
+    def __init__(self, name: str, limit: int, limit_per_host: int, keepalive_timeout: float,
+                 dns_cache_ttl: int, probe_urls=(), probe_method: str = "GET"):
+        self.name = name
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.probe_urls = list(probe_urls)
+        self.probe_method = probe_method
+        self.probe_failures = 0
+        self._session = None
+
+    async def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+                enable_cleanup_closed=True,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def _probe(self, url: str):
+        session = await self.session()
+        start_time = time.perf_counter()
+        try:
+            async with session.request(self.probe_method, url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                await response.read()
+            logger.debug(f"{self.name} pool probe {response.status} in {time.perf_counter() - start_time:.3f}s")
+        except Exception as e:
+            self.probe_failures += 1
+            logger.debug(f"{self.name} pool probe failed: {e}")
+
+    async def warm(self, connections: int = 1):
+        """Opens up to `connections` keep-alive connections to every probe URL."""
+        if not self.probe_urls:
+            return
+        start_time = time.perf_counter()
+        await asyncio.gather(*(self._probe(url) for url in self.probe_urls for _ in range(max(1, connections))))
+        logger.debug(f"Warmed {self.name} connection pool in {time.perf_counter() - start_time:.2f}s "
+                     f"({self.stats()['idle']} idle connections)")
+
+    def stats(self) -> dict:
+        """In-use, idle and waiting connection counts (from connector internals, best effort)."""
+        connector = self._session.connector if self._session is not None and not self._session.closed else None
+        if connector is None:
+            return {"limit": self.limit, "in_use": 0, "idle": 0, "waiting": 0}
+        idle = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+        waiters = getattr(connector, "_waiters", {})
+        waiting = sum(len(w) for w in waiters.values()) if isinstance(waiters, dict) else len(waiters)
+        return {
+            "limit": self.limit,
+            "in_use": len(getattr(connector, "_acquired", ())),
+            "idle": idle,
+            "waiting": waiting,
+        }
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+class KeepWarm:
+    """Re-probes pools periodically so idle keep-alive connections are not dropped upstream."""
+
+    def __init__(self, pools, interval: float):
+        self.pools = list(pools)
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for pool in self.pools:
+                # Only idle pools need it; busy ones are kept open by real traffic
+                if pool.stats()["in_use"] == 0:
+                    await pool.warm()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,150 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class OptimizedImage:
+    """Result of running a reference image through the pipeline."""
+    data: bytes
+    mime_type: str
+    original_size: int
+    cpu_time: float
+    wall_time: float = 0.0
+    reencoded: bool = True
+
+
+def _flatten_to_rgb(img):
+    """Converts any mode to RGB, compositing transparency onto white."""
+    from PIL import Image
+
+    if img.mode in ("RGBA", "P"):
+        # Use white background for transparent images when converting to JPEG
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        if img.mode == "RGBA":
+            background.paste(img, mask=img.split()[3])
+        else:
+            background.paste(img)
+        return background
+    if img.mode != "RGB":
+        return img.convert("RGB")
+    return img
+
+
+def optimize_image(image_bytes: bytes, max_size=(1024, 1024), quality=85,
+                   passthrough_max_bytes=0, fallback_mime_type="image/jpeg") -> OptimizedImage:
+    """
+    Resizes and compresses image to reduce payload size.
+
+    Runs inside a pool worker, so it must stay a plain module-level function.
+    """
+    from PIL import Image
+
+    cpu_start = time.process_time()
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+
+        # Small JPEGs are already what we would produce, send them as-is
+        if (img.format == "JPEG"
+                and img.mode in ("RGB", "L")
+                and img.width <= max_size[0] and img.height <= max_size[1]
+                and len(image_bytes) <= passthrough_max_bytes):
+            return OptimizedImage(image_bytes, "image/jpeg", len(image_bytes),
+                                  time.process_time() - cpu_start, reencoded=False)
+
+        if img.mode == "P":
+            # Palette images resize with NEAREST only, flatten them first
+            img = _flatten_to_rgb(img)
+        else:
+            # Let libjpeg downscale by 1/2, 1/4 or 1/8 while decoding
+            img.draft("RGB", (max_size[0] * 2, max_size[1] * 2))
+
+        # Thumbnail keeps aspect ratio; reducing_gap does a cheap reduce() before LANCZOS
+        img.thumbnail(max_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+        img = _flatten_to_rgb(img)
+
+        output = io.BytesIO()
+        img.save(output, format="JPEG", quality=quality, optimize=True)
+        return OptimizedImage(output.getvalue(), "image/jpeg", len(image_bytes),
+                              time.process_time() - cpu_start)
+    except Exception as e:
+        logger.warning(f"Failed to optimize image: {e}. Using original.")
+        return OptimizedImage(image_bytes, fallback_mime_type, len(image_bytes),
+                              time.process_time() - cpu_start, reencoded=False)
+
+
+def _warm_worker():
+    """Imports Pillow in a pool worker so the first real job does not pay for it."""
+    from PIL import Image, JpegImagePlugin, PngImagePlugin  # noqa: F401
+    return time.process_time()
+
+
+class ImagePipeline:
+    """Bounded process pool that keeps Pillow work off the event loop."""
+
+    def __init__(self, workers: int, max_pending: int, max_size=(1024, 1024), quality=85,
+                 passthrough_max_bytes=0):
+        self.workers = max(1, workers)
+        self.max_size = max_size
+        self.quality = quality
+        self.passthrough_max_bytes = passthrough_max_bytes
+        self._max_pending = max(self.workers, max_pending)
+        self._semaphore = None
+        self._executor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # fork keeps workers from re-importing bot.py as __mp_main__, but is only safe while
+            # this process has a single thread; later (e.g. replacing a broken pool) use forkserver
+            methods = multiprocessing.get_all_start_methods()
+            method = None
+            if "fork" in methods and threading.active_count() == 1:
+                method = "fork"
+            elif "forkserver" in methods:
+                method = "forkserver"
+            context = multiprocessing.get_context(method)
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        return self._executor
+
+    def start(self):
+        """Starts the worker processes up front; call it before anything runs in a thread so they are forked."""
+        executor = self._get_executor()
+        for _ in range(self.workers):
+            executor.submit(_warm_worker)
+
+    async def optimize(self, image_bytes: bytes, mime_type: str = "image/jpeg") -> OptimizedImage:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_pending)
+
+        loop = asyncio.get_running_loop()
+        wall_start = time.perf_counter()
+        async with self._semaphore:
+            args = (image_bytes, self.max_size, self.quality, self.passthrough_max_bytes, mime_type)
+            try:
+                result = await loop.run_in_executor(self._get_executor(), optimize_image, *args)
+            except BrokenProcessPool:
+                logger.warning("Image worker pool broke, restarting it and processing in a thread.")
+                self._executor = None
+                result = await asyncio.to_thread(optimize_image, *args)
+
+        result.wall_time = time.perf_counter() - wall_start
+        if result.reencoded:
+            logger.info(f"Image optimized: {result.original_size/1024:.1f}KB -> {len(result.data)/1024:.1f}KB "
+                        f"(cpu: {result.cpu_time*1000:.0f}ms, wall: {result.wall_time*1000:.0f}ms)")
+        else:
+            logger.info(f"Image passed through: {result.original_size/1024:.1f}KB "
+                        f"(cpu: {result.cpu_time*1000:.0f}ms, wall: {result.wall_time*1000:.0f}ms)")
+        return result
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
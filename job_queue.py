@@ -0,0 +1,258 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from ai_service import NonRetryableError
+from rate_limit import RateLimitError
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    image BLOB NOT NULL,
+    result BLOB,
+    error_kind TEXT,
+    error TEXT,
+    retry_after REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+"""
+
+
+class WorkerTimeoutError(Exception):
+    """Exception raised when no worker finished a queued job in time."""
+    pass
+
+
+class JobQueue:
+    """
+    SQLite-backed generation queue shared by the bot front-end and worker processes.
+
+    The front-end enqueues jobs and collects results; workers claim jobs with a
+    lease they renew while generating. Jobs whose lease expires (a worker died)
+    are handed to another worker, up to `max_attempts` times. All methods are
+    blocking; call them through asyncio.to_thread.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = 60, max_attempts: int = 3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def enqueue(self, params: dict, image: bytes) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO jobs (status, params, image, created_at) VALUES (?, ?, ?, ?)",
+                (QUEUED, json.dumps(params), image, time.time()),
+            )
+            return cursor.lastrowid
+
+    def claim(self, worker: str):
+        """Leases the oldest runnable job to `worker`; returns (id, params, image) or None."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Jobs abandoned by a dead worker go back to the front of the line
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, error_kind = 'error', error = 'Worker lost the job', "
+                    "finished_at = ? WHERE status = ? AND lease_until < ? AND attempts >= ?",
+                    (FAILED, now, RUNNING, now, self.max_attempts),
+                )
+                row = self._conn.execute(
+                    "SELECT id, params, image FROM jobs WHERE status = ? OR (status = ? AND lease_until < ?) "
+                    "ORDER BY id LIMIT 1",
+                    (QUEUED, RUNNING, now),
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1 "
+                        "WHERE id = ?",
+                        (RUNNING, worker, now + self.lease_seconds, row[0]),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), row[2]
+
+    def renew(self, job_ids, worker: str):
+        if not job_ids:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = ?",
+                [(time.time() + self.lease_seconds, job_id, worker, RUNNING) for job_id in job_ids],
+            )
+
+    def complete(self, job_id: int, result: bytes):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, image = x'', finished_at = ? WHERE id = ?",
+                (DONE, result, time.time(), job_id),
+            )
+
+    def fail(self, job_id: int, error_kind: str, error: str, retry_after: float = None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error_kind = ?, error = ?, retry_after = ?, image = x'', "
+                "finished_at = ? WHERE id = ?",
+                (FAILED, error_kind, error, retry_after, time.time(), job_id),
+            )
+
+    def finished(self, job_ids):
+        """Returns finished jobs among `job_ids` as {id: (status, result, error_kind, error, retry_after)}."""
+        if not job_ids:
+            return {}
+        placeholders = ",".join("?" * len(job_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, status, result, error_kind, error, retry_after FROM jobs "
+                f"WHERE id IN ({placeholders}) AND status IN (?, ?)",
+                (*job_ids, DONE, FAILED),
+            ).fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def delete(self, job_ids):
+        if not job_ids:
+            return
+        with self._lock:
+            self._conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in job_ids])
+
+    def purge(self, older_than: float):
+        """Deletes finished jobs nobody collected, e.g. after a front-end restart."""
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                               (DONE, FAILED, time.time() - older_than))
+
+    def counts(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def describe_error(e: Exception):
+    """Maps an exception to the (kind, message, retry_after) stored with a failed job."""
+    if isinstance(e, RateLimitError):
+        return "rate_limited", str(e), e.retry_after
+    if isinstance(e, NonRetryableError):
+        return "non_retryable", str(e), None
+    return "error", str(e), None
+
+
+def rebuild_error(error_kind: str, error: str, retry_after: float = None) -> Exception:
+    """Inverse of describe_error, so the front-end reports worker failures like local ones."""
+    if error_kind == "rate_limited":
+        return RateLimitError(error, retry_after=retry_after)
+    if error_kind == "non_retryable":
+        return NonRetryableError(error)
+    return Exception(error)
+
+
+class RemoteGenerator:
+    """
+    Front-end side of the job queue, with the same generate_sticker signature as AIService.
+
+    One poller task checks all outstanding jobs in a single query and resolves
+    their futures, so waiting on many jobs costs one read per poll interval.
+    """
+
+    def __init__(self, queue: JobQueue, poll_interval: float = 0.25, timeout: float = 300):
+        self.queue = queue
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._waiting = {}  # job id -> future
+        self._poller = None
+        self._counts = {}
+        self._counts_refresh = None
+
+    async def generate_sticker(self, sticker_prompt: str, reference_image_bytes: bytes, mime_type: str = "image/png",
+                               style_name: str = None, reuse_reference: bool = False, gate=None) -> bytes:
+        """Queues the job for a worker; gate(factory), if given, wraps the whole round trip."""
+        if gate is not None:
+            return await gate(lambda: self.generate_sticker(sticker_prompt, reference_image_bytes, mime_type,
+                                                            style_name, reuse_reference))
+        params = {"prompt": sticker_prompt, "mime_type": mime_type, "style_name": style_name,
+                  "reuse_reference": reuse_reference}
+        job_id = await asyncio.to_thread(self.queue.enqueue, params, reference_image_bytes)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[job_id] = future
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.create_task(self._poll())
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise WorkerTimeoutError(f"No generation worker finished the job within {self.timeout:.0f}s")
+        finally:
+            if self._waiting.pop(job_id, None) is not None:
+                # Abandoned (timeout or cancel): drop it so no worker spends quota on it
+                await asyncio.to_thread(self.queue.delete, [job_id])
+
+    async def _poll(self):
+        while self._waiting:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                finished = await asyncio.to_thread(self.queue.finished, list(self._waiting))
+            except sqlite3.Error as e:
+                logger.warning(f"Polling the job queue failed: {e}")
+                continue
+            for job_id, (status, result, error_kind, error, retry_after) in finished.items():
+                future = self._waiting.pop(job_id, None)
+                if future is None or future.done():
+                    continue
+                if status == DONE:
+                    future.set_result(result)
+                else:
+                    future.set_exception(rebuild_error(error_kind, error, retry_after))
+            if finished:
+                await asyncio.to_thread(self.queue.delete, list(finished))
+
+    def stats(self) -> dict:
+        """Last known job counts per status; refreshed in the background so callers never block on SQLite."""
+        if self._counts_refresh is None or self._counts_refresh.done():
+            self._counts_refresh = asyncio.create_task(self._refresh_counts())
+        return {"waiting": len(self._waiting), **self._counts}
+
+    async def _refresh_counts(self):
+        try:
+            self._counts = await asyncio.to_thread(self.queue.counts)
+        except sqlite3.Error as e:
+            logger.warning(f"Counting jobs in the queue failed: {e}")
+
+    def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+        if self._counts_refresh is not None:
+            self._counts_refresh.cancel()
+        self.queue.close()
@@ -0,0 +1,283 @@
+import asyncio
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _format_labels(names, values, extra=None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+
+    def _key(self, labels: dict):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def values(self) -> dict:
+        """Current values keyed by label-value tuples."""
+        return dict(self._values)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """Counts the block as in flight while it runs."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = ("le", _format_value(bound) if bound != float("inf") else "+Inf")
+                yield f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.label_names, key)} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """Registers a callable run before each scrape to refresh gauges from live objects."""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.debug(f"Metrics collector failed: {e}")
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "viba_stage_seconds", "Time spent per pipeline stage.", ["stage", "model"]))
+ATTEMPTS = REGISTRY.register(Counter(
+    "viba_gemini_attempts_total", "Gemini generateContent attempts by model and outcome.", ["model", "outcome"]))
+FALLBACKS = REGISTRY.register(Counter(
+    "viba_fallbacks_total", "Fallback model launches, hedged or after a primary failure.", ["kind"]))
+BYTES = REGISTRY.register(Counter(
+    "viba_bytes_total", "Bytes moved per direction and kind of payload.", ["direction", "kind"]))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    "viba_in_flight", "Operations currently in progress.", ["stage"]))
+REQUESTS = REGISTRY.register(Counter(
+    "viba_requests_total", "Slash command requests by command and outcome.", ["command", "outcome"]))
+IMAGE_CPU_SECONDS = REGISTRY.register(Histogram(
+    "viba_image_cpu_seconds", "CPU time per reference image in the image worker pool.", ["reencoded"]))
+LOOP_LAG = REGISTRY.register(Histogram(
+    "viba_event_loop_lag_seconds", "How late the event loop woke a periodic timer.", buckets=LAG_BUCKETS))
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "viba_cache_lookups_total", "Sticker cache lookups by result.", ["result"]))
+SCHEDULER_JOBS = REGISTRY.register(Gauge(
+    "viba_scheduler_jobs", "Jobs in the scheduler by state.", ["state"]))
+CIRCUIT_STATE = REGISTRY.register(Gauge(
+    "viba_circuit_state", "Circuit breaker state per model (0 closed, 1 half-open, 2 open).", ["model"]))
+MODEL_ERROR_RATE = REGISTRY.register(Gauge(
+    "viba_model_error_rate", "Recent error rate per model.", ["model"]))
+HTTP_POOL = REGISTRY.register(Gauge(
+    "viba_http_pool_connections", "HTTP connection pool usage (in_use, idle, waiting, limit).", ["pool", "state"]))
+STARTUP_SECONDS = REGISTRY.register(Gauge(
+    "viba_startup_seconds", "Duration of each startup phase of this process.", ["phase"]))
+RATE_LIMIT_BLOCKED = REGISTRY.register(Gauge(
+    "viba_rate_limit_blocked_seconds", "Seconds until a rate-limited model accepts requests again.", ["model"]))
+
+
+class StartupTimer:
+    """Records how long each startup phase took, for a one-line report once the bot is ready."""
+
+    def __init__(self, started_at: float = None):
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        self._last = self.started_at
+        self.phases = {}
+        self.steps = {}
+        self.reported = False
+
+    def mark(self, name: str):
+        """Ends phase `name` now; it began where the previous phase ended."""
+        now = time.perf_counter()
+        self.phases[name] = now - self._last
+        self._last = now
+        STARTUP_SECONDS.set(self.phases[name], phase=name)
+
+    async def timed(self, name: str, awaitable):
+        """Awaits and times one step that may run in parallel with others inside the current phase."""
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.steps[name] = time.perf_counter() - start
+            STARTUP_SECONDS.set(self.steps[name], phase=name)
+
+    def total(self) -> float:
+        return self._last - self.started_at
+
+    def report(self) -> str:
+        phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases.items())
+        steps = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.steps.items())
+        return f"Ready in {self.total():.2f}s ({phases})" + (f" [{steps}]" if steps else "")
+
+
+class LoopLagMonitor:
+    """Measures how late a periodic sleep wakes up, i.e. how long something blocked the loop."""
+
+    def __init__(self, interval: float = 0.5, on_sample=None):
+        self.interval = interval
+        self.on_sample = on_sample
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0.0, loop.time() - expected)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            LOOP_LAG.observe(self.last_lag)
+            if self.on_sample is not None:
+                self.on_sample(self.last_lag)
+            if self.last_lag > 1:
+                logger.warning(f"Event loop was blocked for {self.last_lag:.2f}s")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class MetricsServer:
+    """Serves /metrics (Prometheus text format) and /health (JSON) on a local port."""
+
+    def __init__(self, host: str, port: int, health_provider=None, registry: Registry = REGISTRY):
+        self.host = host
+        self.port = port
+        self.health_provider = health_provider
+        self.registry = registry
+        self._runner = None
+
+    async def start(self):
+        # aiohttp's server side is only loaded when the endpoint is enabled
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get("/metrics", self._metrics)
+        app.router.add_get("/health", self._health)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Metrics endpoint listening on http://{self.host}:{self.port}/metrics")
+
+    async def _metrics(self, request):
+        from aiohttp import web
+
+        return web.Response(body=self.registry.render().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def _health(self, request):
+        from aiohttp import web
+
+        return web.json_response(self.health_provider() if self.health_provider else {})
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
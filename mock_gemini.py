@@ -0,0 +1,235 @@
+"""
+Local stand-in for the Gemini generateContent and Files upload endpoints.
+
+Run it and point the bot at it to exercise AIService without spending quota:
+
+    python mock_gemini.py --port 8089
+    GEMINI_API_BASE=http://127.0.0.1:8089 GEMINI_API_KEY=test python bot.py
+
+Latency can follow a fixed, uniform or lognormal distribution, and a share of
+generateContent calls can be answered with 429s, 500s, hangs, safety blocks or
+text-only refusals (see --help). Files passed with --attachment are served at
+/attachments/<n>/<name> so download paths can be exercised too. Counters are at /stats.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import uuid
+
+from aiohttp import web
+
+logger = logging.getLogger("mock_gemini")
+
+
+FAULTS = ("rate_limit", "server_error", "timeout", "blocked", "refusal")
+
+
+class MockGemini:
+    def __init__(self, latency: float = 1.0, image_kb: int = 1024, latency_dist: str = "fixed",
+                 latency_jitter: float = 0.0, faults: dict = None, fault_models=None, hang_seconds: float = 120,
+                 attachment: str = None, seed: int = None):
+        self.latency = latency
+        self.image_kb = image_kb
+        self.latency_dist = latency_dist
+        self.latency_jitter = latency_jitter
+        self.faults = {kind: rate for kind, rate in (faults or {}).items() if rate > 0}
+        self.fault_models = set(fault_models) if fault_models else None  # None = every model
+        self.hang_seconds = hang_seconds
+        self.attachment = attachment
+        self.random = random.Random(seed)
+        self.files = {}  # file id -> (mime_type, bytes)
+        self.upload_sessions = {}  # session id -> (mime_type, declared size)
+        self.generate_requests = 0
+        self.upload_requests = 0
+        self.outcomes = {}  # (model, outcome) -> count
+        self._image_b64 = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/upload/v1beta/files", self.start_upload)
+        app.router.add_post("/upload/v1beta/files/sessions/{session_id}", self.finish_upload)
+        app.router.add_get("/v1beta/models", self.list_models)
+        app.router.add_post("/v1beta/models/{model_action}", self.generate_content)
+        app.router.add_get("/attachments/{index}/{name}", self.get_attachment)
+        app.router.add_get("/stats", self.get_stats)
+        return app
+
+    def sample_latency(self) -> float:
+        if self.latency_dist == "uniform":
+            return self.random.uniform(max(0.0, self.latency - self.latency_jitter), self.latency + self.latency_jitter)
+        if self.latency_dist == "lognormal":
+            # Median at --latency, --latency-jitter is sigma of the underlying normal
+            return self.latency * self.random.lognormvariate(0.0, self.latency_jitter)
+        return self.latency
+
+    def pick_fault(self, model: str):
+        if self.fault_models is not None and model not in self.fault_models:
+            return None
+        roll = self.random.random()
+        for kind, rate in self.faults.items():
+            if roll < rate:
+                return kind
+            roll -= rate
+        return None
+
+    def _count(self, model: str, outcome: str):
+        self.outcomes[(model, outcome)] = self.outcomes.get((model, outcome), 0) + 1
+
+    async def get_attachment(self, request: web.Request) -> web.Response:
+        if not self.attachment:
+            return web.json_response({"error": {"code": 404, "message": "No attachment configured"}}, status=404)
+        return web.FileResponse(self.attachment)
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "generate_requests": self.generate_requests,
+            "upload_requests": self.upload_requests,
+            "outcomes": [{"model": model, "outcome": outcome, "count": count}
+                         for (model, outcome), count in sorted(self.outcomes.items())],
+        })
+
+    async def start_upload(self, request: web.Request) -> web.Response:
+        if request.headers.get("X-Goog-Upload-Command") != "start":
+            return web.json_response({"error": {"code": 400, "message": "Expected upload start"}}, status=400)
+        session_id = uuid.uuid4().hex
+        self.upload_sessions[session_id] = (
+            request.headers.get("X-Goog-Upload-Header-Content-Type", "application/octet-stream"),
+            int(request.headers.get("X-Goog-Upload-Header-Content-Length", "0")),
+        )
+        upload_url = f"{request.url.origin()}/upload/v1beta/files/sessions/{session_id}"
+        return web.Response(headers={"X-Goog-Upload-URL": upload_url, "X-Goog-Upload-Status": "active"})
+
+    async def finish_upload(self, request: web.Request) -> web.Response:
+        session = self.upload_sessions.pop(request.match_info["session_id"], None)
+        if session is None:
+            return web.json_response({"error": {"code": 404, "message": "Unknown upload session"}}, status=404)
+        mime_type, _ = session
+        data = await request.read()
+        file_id = uuid.uuid4().hex[:12]
+        self.files[file_id] = (mime_type, data)
+        self.upload_requests += 1
+        return web.json_response({"file": {
+            "name": f"files/{file_id}",
+            "uri": f"{request.url.origin()}/v1beta/files/{file_id}",
+            "mimeType": mime_type,
+            "sizeBytes": str(len(data)),
+            "state": "ACTIVE",
+        }})
+
+    async def list_models(self, request: web.Request) -> web.Response:
+        return web.json_response({"models": [{"name": "models/gemini-2.5-flash-image"}]})
+
+    def _check_reference(self, payload: dict):
+        """Returns an error message if the request references an unknown file."""
+        for content in payload.get("contents", []):
+            for part in content.get("parts", []):
+                file_data = part.get("fileData")
+                if file_data:
+                    file_id = file_data.get("fileUri", "").rsplit("/", 1)[-1]
+                    if file_id not in self.files:
+                        return f"File {file_id} does not exist or you do not have permission to access it."
+        return None
+
+    def image_response(self) -> dict:
+        # Encoded once: random bytes do not compress, like a real PNG, and re-encoding per call would skew timings
+        if self._image_b64 is None:
+            self._image_b64 = base64.b64encode(os.urandom(self.image_kb * 1024)).decode("ascii")
+        return {
+            "candidates": [{
+                "content": {"role": "model", "parts": [
+                    {"text": "Here is your sticker."},
+                    {"inlineData": {"mimeType": "image/png", "data": self._image_b64}},
+                ]},
+                "finishReason": "STOP",
+                "index": 0,
+            }],
+            "usageMetadata": {"promptTokenCount": 300, "candidatesTokenCount": 1290},
+        }
+
+    @staticmethod
+    def fault_response(kind: str) -> web.Response:
+        if kind == "rate_limit":
+            body = {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED", "message": "Resource has been exhausted",
+                              "details": [
+                                  {"@type": "type.googleapis.com/google.rpc.QuotaFailure",
+                                   "violations": [{"quotaId": "GenerateRequestsPerMinutePerProjectPerModel"}]},
+                                  {"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "2s"},
+                              ]}}
+            return web.json_response(body, status=429)
+        if kind == "server_error":
+            return web.json_response({"error": {"code": 500, "status": "INTERNAL",
+                                                "message": "An internal error has occurred."}}, status=500)
+        if kind == "blocked":
+            return web.json_response({"promptFeedback": {"blockReason": "SAFETY"}})
+        # refusal
+        return web.json_response({"candidates": [{
+            "content": {"role": "model", "parts": [{"text": "I can't create an image of this person."}]},
+            "finishReason": "STOP",
+            "index": 0,
+        }]})
+
+    async def generate_content(self, request: web.Request) -> web.Response:
+        model, _, action = request.match_info["model_action"].partition(":")
+        if action != "generateContent":
+            return web.json_response({"error": {"code": 404, "message": f"Unknown action {action}"}}, status=404)
+        self.generate_requests += 1
+        try:
+            payload = json.loads(await request.read())
+        except ValueError:
+            return web.json_response({"error": {"code": 400, "message": "Invalid JSON payload"}}, status=400)
+
+        error = self._check_reference(payload)
+        if error:
+            return web.json_response({"error": {"code": 400, "message": error, "status": "INVALID_ARGUMENT"}},
+                                     status=400)
+
+        fault = self.pick_fault(model)
+        self._count(model, fault or "ok")
+        if fault == "timeout":
+            await asyncio.sleep(self.hang_seconds)
+        await asyncio.sleep(self.sample_latency())
+        if fault and fault != "timeout":
+            return self.fault_response(fault)
+        return web.json_response(self.image_response())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in Gemini server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=1.0, help="Seconds before each generateContent reply")
+    parser.add_argument("--latency-dist", choices=("fixed", "uniform", "lognormal"), default="fixed")
+    parser.add_argument("--latency-jitter", type=float, default=0.0,
+                        help="Half-width for uniform, sigma for lognormal")
+    parser.add_argument("--image-kb", type=int, default=1024, help="Size of the returned image before base64")
+    for kind in FAULTS:
+        parser.add_argument(f"--{kind.replace('_', '-')}-rate", type=float, default=0.0, dest=f"{kind}_rate",
+                            help=f"Share of generateContent calls answered with a {kind.replace('_', ' ')}")
+    parser.add_argument("--fault-models", default="", help="Comma-separated models faults apply to (default all)")
+    parser.add_argument("--hang-seconds", type=float, default=120, help="How long a timeout fault hangs")
+    parser.add_argument("--attachment", help="Image file served at /attachments/<n>/<name>")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    mock = MockGemini(
+        latency=args.latency,
+        image_kb=args.image_kb,
+        latency_dist=args.latency_dist,
+        latency_jitter=args.latency_jitter,
+        faults={kind: getattr(args, f"{kind}_rate") for kind in FAULTS},
+        fault_models=[m for m in args.fault_models.split(",") if m],
+        hang_seconds=args.hang_seconds,
+        attachment=args.attachment,
+        seed=args.seed,
+    )
+    web.run_app(mock.make_app(), host=args.host, port=args.port, access_log=None,
+                shutdown_timeout=1.0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def _percentile(ordered, q: float):
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class ModelHealth:
+    """
+    Rolling health of one model: recent outcomes, call latencies and a
+    circuit breaker.
+
+    Timed-out and cancelled attempts add their elapsed time as a latency
+    sample. It is only a lower bound, but dropping those attempts would
+    leave just the fast calls and bias the percentiles low.
+
+    The breaker opens when the recent error rate (or the run of consecutive
+    failures) crosses its threshold. After `cooldown` seconds a single
+    half-open probe is let through; success closes the breaker, failure
+    re-opens it with a doubled cooldown (up to `max_cooldown`).
+    """
+
+    def __init__(self, model: str, window: int = 50, window_seconds: float = 300,
+                 failure_rate: float = 0.5, min_requests: int = 6, consecutive_failures: int = 4,
+                 cooldown: float = 30, max_cooldown: float = 300):
+        self.model = model
+        self.window_seconds = window_seconds
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.consecutive_failures_limit = consecutive_failures
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+        self._outcomes = deque(maxlen=window)  # (timestamp, ok)
+        self._latencies = deque(maxlen=window * 4)  # call durations, censored for timeouts/cancellations
+        self.consecutive_failures = 0
+        self.total_successes = 0
+        self.total_failures = 0
+
+        self.state = CLOSED
+        self.cooldown = cooldown
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    # --- statistics ---
+
+    def _recent_outcomes(self):
+        cutoff = time.time() - self.window_seconds
+        while self._outcomes and self._outcomes[0][0] < cutoff:
+            self._outcomes.popleft()
+        return self._outcomes
+
+    def error_rate(self) -> float:
+        outcomes = self._recent_outcomes()
+        if not outcomes:
+            return 0.0
+        return sum(1 for _, ok in outcomes if not ok) / len(outcomes)
+
+    def sample_count(self) -> int:
+        return len(self._latencies)
+
+    def percentile(self, q: float):
+        """Returns the q-th percentile (0..1) of recent call latencies, or None without samples."""
+        if not self._latencies:
+            return None
+        return _percentile(sorted(self._latencies), q)
+
+    # --- circuit breaker ---
+
+    def allow_request(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.time() - self.opened_at >= self.cooldown:
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            logger.info(f"Circuit for {self.model} half-open, sending probe request.")
+            return True
+        return False
+
+    def record_success(self, latency: float):
+        self._outcomes.append((time.time(), True))
+        self._latencies.append(latency)
+        self.consecutive_failures = 0
+        self.total_successes += 1
+        self._probe_in_flight = False
+        if self.state != CLOSED:
+            self.cooldown = self.base_cooldown
+            self._transition(CLOSED)
+
+    def record_failure(self, latency: float = None):
+        """Pass `latency` when the attempt timed out, so it counts as a (censored) latency sample."""
+        self._outcomes.append((time.time(), False))
+        if latency is not None:
+            self._latencies.append(latency)
+        self.consecutive_failures += 1
+        self.total_failures += 1
+        if self.state == HALF_OPEN:
+            self._probe_in_flight = False
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            self._open()
+            return
+        outcomes = self._recent_outcomes()
+        if self.state == CLOSED and (
+                self.consecutive_failures >= self.consecutive_failures_limit
+                or (len(outcomes) >= self.min_requests and self.error_rate() >= self.failure_rate)):
+            self._open()
+
+    def record_cancelled(self, latency: float = None):
+        """
+        An attempt was abandoned (e.g. lost a hedge race); it says nothing about health.
+        Pass `latency` if it was still waiting on the model, as a (censored) latency sample.
+        """
+        self._probe_in_flight = False
+        if latency is not None:
+            self._latencies.append(latency)
+
+    def _open(self):
+        self.opened_at = time.time()
+        self._transition(OPEN)
+
+    def _transition(self, state: str):
+        if state != self.state:
+            logger.warning(f"Circuit for {self.model}: {self.state} -> {state} "
+                           f"(error rate {self.error_rate():.0%}, cooldown {self.cooldown:.0f}s)")
+            self.state = state
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "error_rate": round(self.error_rate(), 3),
+            "recent_requests": len(self._recent_outcomes()),
+            "consecutive_failures": self.consecutive_failures,
+            "successes": self.total_successes,
+            "failures": self.total_failures,
+            "latency_p50": self.percentile(0.5),
+            "latency_p90": self.percentile(0.9),
+            "latency_p99": self.percentile(0.99),
+            "cooldown": self.cooldown,
+            "open_for": round(time.time() - self.opened_at, 1) if self.state != CLOSED else 0.0,
+        }
+
+
+class HealthTracker:
+    """Per-model ModelHealth registry with latency-derived timeouts."""
+
+    def __init__(self, timeout_percentile: float = 0.95, timeout_multiplier: float = 1.5,
+                 timeout_min: float = 8, timeout_max: float = 30, min_samples: int = 20, **health_options):
+        self.timeout_percentile = timeout_percentile
+        self.timeout_multiplier = timeout_multiplier
+        self.timeout_min = timeout_min
+        self.timeout_max = timeout_max
+        self.min_samples = min_samples
+        self._health_options = health_options
+        self._models = {}
+
+    def get(self, model: str) -> ModelHealth:
+        health = self._models.get(model)
+        if health is None:
+            health = self._models[model] = ModelHealth(model, **self._health_options)
+        return health
+
+    def timeout_for(self, model: str, default: float) -> float:
+        """Recent latency percentile times the multiplier, or `default` until enough samples exist."""
+        health = self.get(model)
+        if health.sample_count() < self.min_samples:
+            return default
+        timeout = health.percentile(self.timeout_percentile) * self.timeout_multiplier
+        return min(max(timeout, self.timeout_min), self.timeout_max)
+
+    def quick_retry_cutoff(self, model: str, default: float = 5) -> float:
+        """Failures faster than this are treated as transient and retried on the same model."""
+        health = self.get(model)
+        if health.sample_count() < self.min_samples:
+            return default
+        return min(default, health.percentile(0.5) / 2)
+
+    def snapshot(self) -> dict:
+        return {model: health.snapshot() for model, health in self._models.items()}
+
+
+class HedgeBudget:
+    """
+    Caps hedged requests to a fraction of all requests.
+
+    Every request earns `ratio` credits (up to `burst`); launching a hedge
+    spends one credit, so over time at most `ratio` of requests are hedged.
+    """
+
+    def __init__(self, ratio: float, burst: float = 5.0):
+        self.ratio = ratio
+        self.burst = max(1.0, burst)
+        self._credits = self.burst
+        self.hedged = 0
+        self.requests = 0
+
+    def on_request(self):
+        self.requests += 1
+        self._credits = min(self.burst, self._credits + self.ratio)
+
+    def try_acquire(self) -> bool:
+        if self._credits < 1.0:
+            return False
+        self._credits -= 1.0
+        self.hedged += 1
+        return True
@@ -28,3 +28,12 @@ The 5 TV Screens (Displaying consistent identity):
 - Screen 5: A silhouette or specific body posture detail. 
 Texture & Aesthetics: Classic Fujifilm aesthetic. The TV screens feature vintage CRT texture with subtle grain, faint RGB scanlines, and slight color fading.  High-contrast lighting, avant-garde atmosphere, 90s lo-fi tech aesthetic. Strictly preserve the original background elements"""
 }
+
+# Seconds a generated sticker may be reused for the same photo and preset.
+# Presets that are meant to come out different every time (random animal,
+# random personality word) are deliberately left out and never cached.
+PRESET_CACHE_TTL = {
+    "OOTD": 7 * 24 * 3600,
+    "FishView #35mm": 7 * 24 * 3600,
+    "Selfcast": 7 * 24 * 3600,
+}
@@ -0,0 +1,180 @@
+import asyncio
+import email.utils
+import json
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+# Rough Gemini token accounting for one sticker request
+IMAGE_INPUT_TOKENS = 258
+IMAGE_OUTPUT_TOKENS = 1290
+DEFAULT_RETRY_AFTER = 10.0
+
+_DURATION = re.compile(r"^\s*([\d.]+)s\s*$")
+
+
+class RateLimitError(Exception):
+    """Exception raised when a model is rate limited, by Gemini (429) or by our own quota buckets."""
+
+    def __init__(self, message: str, model: str = None, retry_after: float = None, local: bool = False):
+        super().__init__(message)
+        self.model = model
+        self.retry_after = retry_after
+        self.local = local
+
+
+def estimate_tokens(prompt: str) -> int:
+    """Approximate input + output tokens charged for one generation."""
+    return len(prompt) // 4 + IMAGE_INPUT_TOKENS + IMAGE_OUTPUT_TOKENS
+
+
+def parse_retry_after(headers, body_text: str):
+    """
+    Returns (retry_after_seconds, quota_id) from a 429 response.
+
+    Looks at the Retry-After header (seconds or HTTP date) and at the
+    google.rpc.RetryInfo / QuotaFailure details in the error body.
+    """
+    retry_after = None
+    quota_id = None
+
+    header = headers.get("Retry-After") if headers else None
+    if header:
+        try:
+            retry_after = float(header)
+        except ValueError:
+            try:
+                retry_after = max(0.0, email.utils.parsedate_to_datetime(header).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    try:
+        details = json.loads(body_text).get("error", {}).get("details", [])
+    except (ValueError, AttributeError):
+        details = []
+    for detail in details:
+        if not isinstance(detail, dict):
+            continue
+        kind = detail.get("@type", "")
+        if kind.endswith("google.rpc.RetryInfo") and retry_after is None:
+            match = _DURATION.match(str(detail.get("retryDelay", "")))
+            if match:
+                retry_after = float(match.group(1))
+        elif kind.endswith("google.rpc.QuotaFailure"):
+            violations = detail.get("violations") or []
+            if violations:
+                quota_id = violations[0].get("quotaId") or violations[0].get("quotaMetric")
+
+    return retry_after, quota_id
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `per_minute` / 60 per second."""
+
+    def __init__(self, per_minute: float, capacity: float = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` tokens are available (0 if they are now)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self._tokens >= amount:
+            return 0.0
+        return (amount - self._tokens) / self.rate
+
+    def take(self, amount: float):
+        self._refill()
+        self._tokens -= min(amount, self.capacity)
+
+    def drain(self):
+        self._refill()
+        self._tokens = min(self._tokens, 0.0)
+
+
+class ModelRateLimiter:
+    """Client-side RPM/TPM buckets for one model, plus any server-imposed Retry-After block."""
+
+    def __init__(self, model: str, rpm: float = 0, tpm: float = 0):
+        self.model = model
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.blocked_until = 0.0
+        self.throttled = 0
+        self.rejected = 0
+        self._lock = asyncio.Lock()
+
+    def _wait_time(self, tokens: int) -> float:
+        wait = max(0.0, self.blocked_until - time.time())
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    async def acquire(self, tokens: int, max_wait: float):
+        """Waits up to max_wait seconds for capacity, or raises RateLimitError straight away."""
+        deadline = time.monotonic() + max_wait
+        async with self._lock:
+            wait = self._wait_time(tokens)
+            if wait > deadline - time.monotonic():
+                self.rejected += 1
+                raise RateLimitError(f"Rate limit for {self.model}: no capacity for {wait:.0f}s",
+                                     model=self.model, retry_after=wait, local=True)
+            if wait > 0:
+                self.throttled += 1
+                logger.info(f"Waiting {wait:.2f}s for {self.model} rate limit capacity...")
+                await asyncio.sleep(wait)
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+
+    def penalize(self, retry_after: float):
+        """Blocks the model after a 429 until the server says it may be retried."""
+        self.blocked_until = max(self.blocked_until, time.time() + retry_after)
+        if self.requests is not None:
+            self.requests.drain()
+
+
+class RateLimiter:
+    """Per-model rate limiters keyed by model name."""
+
+    def __init__(self, quotas: dict, max_wait: float):
+        self.quotas = quotas  # model -> (rpm, tpm)
+        self.max_wait = max_wait
+        self._models = {}
+
+    def get(self, model: str) -> ModelRateLimiter:
+        limiter = self._models.get(model)
+        if limiter is None:
+            rpm, tpm = self.quotas.get(model, (0, 0))
+            limiter = self._models[model] = ModelRateLimiter(model, rpm, tpm)
+        return limiter
+
+    async def acquire(self, model: str, tokens: int):
+        await self.get(model).acquire(tokens, self.max_wait)
+
+    def penalize(self, model: str, retry_after: float = None):
+        retry_after = DEFAULT_RETRY_AFTER if retry_after is None else retry_after
+        logger.warning(f"{model} rate limited by Gemini, holding requests for {retry_after:.1f}s")
+        self.get(model).penalize(retry_after)
+
+    def snapshot(self) -> dict:
+        return {
+            model: {
+                "blocked_for": round(max(0.0, limiter.blocked_until - time.time()), 1),
+                "throttled": limiter.throttled,
+                "rejected": limiter.rejected,
+            }
+            for model, limiter in self._models.items()
+        }
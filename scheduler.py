@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+from metrics import IN_FLIGHT, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Exception raised when a job is rejected because the queue or the user's quota is full."""
+    pass
+
+
+class _Job:
+    __slots__ = ("user_id", "guild_id", "factory", "future", "on_update", "enqueued_at", "position")
+
+    def __init__(self, user_id, guild_id, factory, future, on_update):
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.factory = factory
+        self.future = future
+        self.on_update = on_update
+        self.enqueued_at = time.time()
+        self.position = None
+
+
+class JobScheduler:
+    """
+    Fair queue in front of Gemini.
+
+    At most `max_concurrency` jobs run at once. Waiting jobs are dispatched
+    round-robin across guilds, and across users within a guild, so one busy
+    user or server cannot starve the rest. Submissions beyond `max_queue_depth`
+    waiting jobs, or beyond `max_per_user` queued + running jobs for a user,
+    are rejected immediately with QueueFullError.
+
+    `on_update(position, eta_seconds)` is called whenever a job's queue
+    position changes, and with position 0 when it starts running.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue_depth: int, max_per_user: int,
+                 default_job_seconds: float = 20.0):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue_depth = max_queue_depth
+        self.max_per_user = max_per_user
+        self.avg_job_seconds = default_job_seconds
+
+        self._queues = OrderedDict()  # guild -> OrderedDict(user -> deque of jobs)
+        self._queued = 0
+        self._running = 0
+        self._per_user = {}
+        self._tasks = set()  # running job tasks; asyncio only keeps weak references to them
+        self.rejected = 0
+        self.completed = 0
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    async def submit(self, user_id, guild_id, factory, on_update=None):
+        """Queues factory() and returns its result once it has run."""
+        if self._queued >= self.max_queue_depth:
+            self.rejected += 1
+            raise QueueFullError("The sticker queue is full right now. Please try again in a minute.")
+        if self._per_user.get(user_id, 0) >= self.max_per_user:
+            self.rejected += 1
+            raise QueueFullError(f"You already have {self.max_per_user} stickers in progress. "
+                                 f"Please wait for them to finish.")
+
+        job = _Job(user_id, guild_id, factory, asyncio.get_running_loop().create_future(), on_update)
+        self._queues.setdefault(guild_id, OrderedDict()).setdefault(user_id, deque()).append(job)
+        self._queued += 1
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+
+        self._dispatch()
+        self._notify_positions()
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            if self._remove(job):
+                self._release_user(user_id)
+                self._notify_positions()
+            raise
+
+    # --- internals ---
+
+    def _dispatch_order(self):
+        """Waiting jobs in the order they would be dispatched."""
+        guilds = [(guild, [deque(jobs) for jobs in users.values()]) for guild, users in self._queues.items()]
+        order = []
+        while guilds:
+            next_round = []
+            for guild, users in guilds:
+                user_jobs = users.pop(0)
+                order.append(user_jobs.popleft())
+                if user_jobs:
+                    users.append(user_jobs)
+                if users:
+                    next_round.append((guild, users))
+            guilds = next_round
+        return order
+
+    def _pop_next(self):
+        guild, users = next(iter(self._queues.items()))
+        user, jobs = next(iter(users.items()))
+        job = jobs.popleft()
+        # Rotate the user and guild to the back of their round-robin rings
+        del users[user]
+        if jobs:
+            users[user] = jobs
+        del self._queues[guild]
+        if users:
+            self._queues[guild] = users
+        self._queued -= 1
+        return job
+
+    def _remove(self, job: _Job) -> bool:
+        users = self._queues.get(job.guild_id)
+        jobs = users.get(job.user_id) if users else None
+        if not jobs or job not in jobs:
+            return False
+        jobs.remove(job)
+        if not jobs:
+            del users[job.user_id]
+        if not users:
+            del self._queues[job.guild_id]
+        self._queued -= 1
+        return True
+
+    def _release_user(self, user_id):
+        remaining = self._per_user.get(user_id, 1) - 1
+        if remaining > 0:
+            self._per_user[user_id] = remaining
+        else:
+            self._per_user.pop(user_id, None)
+
+    def _dispatch(self):
+        while self._running < self.max_concurrency and self._queued:
+            job = self._pop_next()
+            self._running += 1
+            task = asyncio.create_task(self._run(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job: _Job):
+        started = time.time()
+        STAGE_SECONDS.observe(started - job.enqueued_at, stage="queue_wait")
+        IN_FLIGHT.inc(stage="job")
+        self._call_update(job, 0, 0.0)
+        logger.info(f"Job for user {job.user_id} started after {started - job.enqueued_at:.2f}s in queue "
+                    f"(running: {self._running}, queued: {self._queued})")
+        try:
+            result = await job.factory()
+            if not job.future.done():
+                job.future.set_result(result)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            # Cancelled jobs (e.g. on shutdown) must not leave submit() waiting forever
+            if not job.future.done():
+                job.future.cancel()
+            IN_FLIGHT.dec(stage="job")
+            self._running -= 1
+            self.completed += 1
+            self._release_user(job.user_id)
+            # Exponential moving average of job duration, used for ETAs
+            self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * (time.time() - started)
+            self._dispatch()
+            self._notify_positions()
+
+    def _notify_positions(self):
+        for index, job in enumerate(self._dispatch_order()):
+            position = index + 1
+            if job.position != position:
+                job.position = position
+                eta = (index // self.max_concurrency + 1) * self.avg_job_seconds
+                self._call_update(job, position, eta)
+
+    @staticmethod
+    def _call_update(job: _Job, position: int, eta: float):
+        if job.on_update is None:
+            return
+        try:
+            job.on_update(position, eta)
+        except Exception as e:
+            logger.debug(f"Queue position update failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "running": self._running,
+            "queued": self._queued,
+            "max_concurrency": self.max_concurrency,
+            "avg_job_seconds": round(self.avg_job_seconds, 2),
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
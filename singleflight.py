@@ -0,0 +1,57 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key into one underlying task.
+
+    The work runs as its own task, so a caller giving up (e.g. its interaction
+    being cancelled) does not cancel the result for everyone else; the task is
+    only cancelled once every waiter has left. Exceptions raised by the work are
+    delivered to every waiter.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, fn):
+        """Awaits fn() for the first caller of key, and the same result for any concurrent callers."""
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.create_task(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _task: self._forget(key, call))
+        else:
+            self.coalesced += 1
+            logger.info(f"Joining in-flight generation {str(key)[:12]} ({call.waiters} already waiting)")
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if not call.task.done() and call.waiters == 1:
+                logger.info(f"All waiters left generation {str(key)[:12]}, cancelling it")
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    def _forget(self, key, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # Mark the exception as retrieved when nobody was left to await it
+        if not call.task.cancelled():
+            call.task.exception()
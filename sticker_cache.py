@@ -0,0 +1,194 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(reference_bytes: bytes, style_name: str, sticker_prompt: str, model: str) -> str:
+    """Content address for a generation: reference image + preset + model."""
+    prompt_hash = hashlib.sha256(sticker_prompt.encode("utf-8")).hexdigest()
+    digest = hashlib.sha256()
+    digest.update(hashlib.sha256(reference_bytes).digest())
+    for part in (style_name or "", prompt_hash, model):
+        digest.update(b"\0")
+        digest.update(part.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class StickerCache:
+    """
+    Two-tier result cache: a byte-bounded in-memory LRU in front of a disk
+    directory with its own byte budget. Entries carry their write time so the
+    caller can apply a per-preset TTL on lookup.
+
+    Several processes (the bot and queue workers) may share the directory, so
+    the disk index is only a local view: lookups fall back to the file itself,
+    and the index is rebuilt from the directory before evicting.
+    """
+
+    def __init__(self, directory: str, memory_max_bytes: int, disk_max_bytes: int):
+        self.directory = directory
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()  # key -> (data, stored_at)
+        self._memory_bytes = 0
+        self._disk_index = None  # key -> (size, stored_at), in LRU order
+        self._disk_bytes = 0
+        # Rescan after writing this much (other processes write too), and evict down to the low water mark
+        self._disk_rescan_bytes = disk_max_bytes // 10
+        self._disk_low_water = disk_max_bytes - self._disk_rescan_bytes
+        self._disk_written = 0
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.png")
+
+    # --- memory tier ---
+
+    def _memory_get(self, key: str, ttl: float):
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        data, stored_at = entry
+        if time.time() - stored_at > ttl:
+            self._memory_pop(key)
+            return None
+        self._memory.move_to_end(key)
+        return data
+
+    def _memory_put(self, key: str, data: bytes, stored_at: float):
+        if len(data) > self.memory_max_bytes:
+            return
+        self._memory_pop(key)
+        self._memory[key] = (data, stored_at)
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_max_bytes:
+            _, (old_data, _) = self._memory.popitem(last=False)
+            self._memory_bytes -= len(old_data)
+
+    def _memory_pop(self, key: str):
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_bytes -= len(entry[0])
+
+    # --- disk tier (runs in a thread) ---
+
+    def _load_disk_index(self, log: bool = True):
+        entries = []
+        if os.path.isdir(self.directory):
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    if not name.endswith(".png"):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except OSError:
+                        continue
+                    entries.append((stat.st_atime, name[:-4], stat.st_size, stat.st_mtime))
+        entries.sort()
+        self._disk_index = OrderedDict((key, (size, mtime)) for _, key, size, mtime in entries)
+        self._disk_bytes = sum(size for size, _ in self._disk_index.values())
+        self._disk_written = 0
+        if log:
+            logger.info(f"Sticker cache: {len(self._disk_index)} entries ({self._disk_bytes/1024/1024:.1f}MB) on disk")
+
+    def _disk_get(self, key: str, ttl: float):
+        if self._disk_index is None:
+            self._load_disk_index()
+        entry = self._disk_index.get(key)
+        if entry is None:
+            # Possibly written by another process sharing the directory
+            try:
+                stat = os.stat(self._path(key))
+            except OSError:
+                return None
+            entry = (stat.st_size, stat.st_mtime)
+            self._disk_index[key] = entry
+            self._disk_bytes += entry[0]
+        size, stored_at = entry
+        if time.time() - stored_at > ttl:
+            self._disk_remove(key)
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            # Bump atime (mtime is the write time) so other processes' rescans see the use
+            os.utime(self._path(key), (time.time(), stored_at))
+        except OSError:
+            self._disk_remove(key)
+            return None
+        self._disk_index.move_to_end(key)
+        return data, stored_at
+
+    def _disk_put(self, key: str, data: bytes, stored_at: float):
+        if self._disk_index is None:
+            self._load_disk_index()
+        if len(data) > self.disk_max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.utime(tmp_path, (stored_at, stored_at))
+        os.replace(tmp_path, path)
+
+        old = self._disk_index.pop(key, None)
+        if old is not None:
+            self._disk_bytes -= old[0]
+        self._disk_index[key] = (len(data), stored_at)
+        self._disk_bytes += len(data)
+        self._disk_written += len(data)
+
+        if self._disk_bytes > self.disk_max_bytes or self._disk_written >= self._disk_rescan_bytes:
+            # Count what other processes wrote or already evicted before deciding what to drop
+            self._load_disk_index(log=False)
+            if self._disk_bytes > self.disk_max_bytes:
+                while self._disk_bytes > self._disk_low_water and len(self._disk_index) > 1:
+                    self._disk_remove(next(iter(self._disk_index)))
+
+    def _disk_remove(self, key: str):
+        entry = self._disk_index.pop(key, None)
+        if entry is not None:
+            self._disk_bytes -= entry[0]
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    # --- public API ---
+
+    async def get(self, key: str, ttl: float):
+        """Returns cached sticker bytes, or None on a miss or expired entry."""
+        data = self._memory_get(key, ttl)
+        if data is None:
+            async with self._lock:
+                try:
+                    found = await asyncio.to_thread(self._disk_get, key, ttl)
+                except Exception as e:
+                    logger.warning(f"Sticker cache disk read failed: {e}")
+                    found = None
+            if found is not None:
+                data, stored_at = found
+                self._memory_put(key, data, stored_at)
+
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    async def set(self, key: str, data: bytes):
+        stored_at = time.time()
+        self._memory_put(key, data, stored_at)
+        async with self._lock:
+            try:
+                await asyncio.to_thread(self._disk_put, key, data, stored_at)
+            except Exception as e:
+                logger.warning(f"Sticker cache disk write failed: {e}")
@@ -0,0 +1,119 @@
+"""
+Generation worker for GENERATION_BACKEND=queue.
+
+Claims jobs from the shared SQLite job queue, runs AIService.generate_sticker
+and stores the result for the bot front-end to deliver. Run as many as needed:
+
+    python worker.py --concurrency 4
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import socket
+
+from ai_service import AIService
+from config import JOB_QUEUE_PATH, JOB_LEASE_SECONDS, JOB_POLL_SECONDS, WORKER_CONCURRENCY, METRICS_HOST
+from job_queue import JobQueue, describe_error
+from metrics import MetricsServer
+
+logger = logging.getLogger("viba_sticker_worker")
+
+
+class GenerationWorker:
+    def __init__(self, queue: JobQueue, ai_service: AIService, concurrency: int, poll_interval: float):
+        self.queue = queue
+        self.ai_service = ai_service
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self._running = {}  # job id -> task
+        self._stopping = asyncio.Event()
+
+    def stop(self):
+        logger.info("Stopping: finishing running jobs, not claiming new ones.")
+        self._stopping.set()
+
+    async def run(self):
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            while not self._stopping.is_set():
+                if len(self._running) >= self.concurrency:
+                    await asyncio.wait(self._running.values(), return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                job = await asyncio.to_thread(self.queue.claim, self.name)
+                if job is None:
+                    try:
+                        await asyncio.wait_for(self._stopping.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                job_id, params, image = job
+                self._running[job_id] = asyncio.create_task(self._process(job_id, params, image))
+            if self._running:
+                await asyncio.wait(self._running.values())
+        finally:
+            heartbeat.cancel()
+
+    async def _process(self, job_id: int, params: dict, image: bytes):
+        logger.info(f"Job {job_id}: generating style {params.get('style_name')} ({len(image)/1024:.1f}KB reference)")
+        try:
+            result = await self.ai_service.generate_sticker(
+                params["prompt"], image, params.get("mime_type", "image/png"),
+                style_name=params.get("style_name"), reuse_reference=params.get("reuse_reference", False),
+            )
+            await asyncio.to_thread(self.queue.complete, job_id, result)
+            logger.info(f"Job {job_id}: done ({len(result)/1024:.1f}KB)")
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            await asyncio.to_thread(self.queue.fail, job_id, *describe_error(e))
+        finally:
+            self._running.pop(job_id, None)
+
+    async def _heartbeat(self):
+        """Renews leases on running jobs so other workers do not take them over."""
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            try:
+                await asyncio.to_thread(self.queue.renew, list(self._running), self.name)
+                # Results nobody collected (front-end restarted) are dropped after an hour
+                await asyncio.to_thread(self.queue.purge, 3600)
+            except Exception as e:
+                logger.warning(f"Job lease renewal failed: {e}")
+
+
+async def main(concurrency: int, metrics_port: int):
+    ai_service = AIService()
+    ai_service.image_pipeline.start()
+    await ai_service.warm_up()
+
+    queue = JobQueue(JOB_QUEUE_PATH, lease_seconds=JOB_LEASE_SECONDS)
+    worker = GenerationWorker(queue, ai_service, concurrency, JOB_POLL_SECONDS)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+
+    metrics_server = None
+    if metrics_port:
+        metrics_server = MetricsServer(METRICS_HOST, metrics_port, ai_service.health_snapshot)
+        await metrics_server.start()
+
+    logger.info(f"Worker {worker.name} started (concurrency: {worker.concurrency}, queue: {JOB_QUEUE_PATH})")
+    try:
+        await worker.run()
+    finally:
+        if metrics_server is not None:
+            await metrics_server.stop()
+        await ai_service.close()
+        queue.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Viba sticker generation worker")
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY, help="Jobs generated at once")
+    parser.add_argument("--metrics-port", type=int, default=0, help="Serve /metrics on this port (0 = off)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(main(args.concurrency, args.metrics_port))